@@ -0,0 +1,237 @@
+"""
+Benchmark the nightly notification pipeline against local stand-ins for
+the menu APIs and Twilio.
+
+	python benchmarks/bench_pipeline.py --users 10000 --schools 20
+
+Seeds a throwaway database with synthetic subscribers, points the menu
+URLs and send_text at local fake servers with configurable latency and
+error rates, then reports end-to-end duration, throughput, peak RSS and
+per-stage timings.
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+def parse_args():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--schools', type=int, default=2)
+	parser.add_argument('--menu-latency', type=float, default=0.2,
+											help='Seconds per menu API call')
+	parser.add_argument('--menu-errors', type=float, default=0,
+											help='Fraction of menu API calls that fail')
+	parser.add_argument('--sms-latency', type=float, default=0.1,
+											help='Seconds per Twilio call')
+	parser.add_argument('--sms-errors', type=float, default=0,
+											help='Fraction of Twilio calls that fail')
+	parser.add_argument('--concurrency', type=int, default=None)
+	parser.add_argument('--rate', type=float, default=0,
+											help='Messages per second, 0 for unlimited')
+	parser.add_argument('--warm', action='store_true',
+											help='Cache menus before the timed run')
+	parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+	return parser.parse_args()
+
+class FakeServer:
+	def __init__(self, handler, latency: float, errors: float):
+		self.calls = 0
+		self.lock = threading.Lock()
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def respond(self):
+				with server.lock:
+					server.calls += 1
+				time.sleep(latency)
+				if random.random() < errors:
+					self.send_response(503)
+					self.end_headers()
+					return
+				body = json.dumps(handler(self)).encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			do_GET = respond
+			do_POST = respond
+
+			def log_message(self, *args):
+				pass
+
+		self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.httpd.daemon_threads = True
+		self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+		threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+	def close(self):
+		self.httpd.shutdown()
+
+def menu_types(request):
+	params = parse_qs(urlsplit(request.path).query)
+	meal_id = params['_id'][0]
+	year = time.localtime().tm_year
+	return {'menus': [{'id': f'{meal_id}-{y}-{m}', 'year': y, 'month': m}
+										for y in (year - 1, year, year + 1) for m in range(12)]}
+
+def menu_items(request):
+	items = [
+		{'day': day, 'product': {
+			'id': f'p{day}{i}',
+			'name': f'Entree {day}-{i}',
+			'long_description': 'Served with a side of fruit and milk\nAllergens: wheat',
+			'category': 'Entree' if i else 'Ancillary',
+		}}
+		for day in range(1, 32) for i in range(4)
+	]
+	return {'data': {'menu': {'items': items}}}
+
+def twilio_message(request):
+	return {'sid': f'SM{random.getrandbits(64):016x}'}
+
+class StageTimer:
+	def __init__(self):
+		self.totals = defaultdict(float)
+		self.counts = defaultdict(int)
+
+	def wrap(self, stage, f):
+		def wrapper(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return f(*args, **kwargs)
+			finally:
+				self.totals[stage] += time.perf_counter() - start
+				self.counts[stage] += 1
+		return wrapper
+
+	def wrap_iter(self, stage, f):
+		def wrapper(*args, **kwargs):
+			it = f(*args, **kwargs)
+			while True:
+				start = time.perf_counter()
+				try:
+					item = next(it)
+				except StopIteration:
+					return
+				finally:
+					self.totals[stage] += time.perf_counter() - start
+				self.counts[stage] += 1
+				yield item
+		return wrapper
+
+def main():
+	args = parse_args()
+	# Settings read at import time
+	os.environ.setdefault('TWILIO_ACCOUNT_SID', 'AC' + '0' * 32)
+	os.environ.setdefault('TWILIO_AUTH_TOKEN', 'benchmark')
+	os.environ['MENU_NOTIFIER_SEND_RATE'] = str(args.rate)
+	if args.concurrency:
+		os.environ['MENU_NOTIFIER_SEND_CONCURRENCY'] = str(args.concurrency)
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+	from menuNotifierApp import create_app, menu_notifier, outbox
+	from menuNotifierApp.db import get_db, init_db
+
+	menu_server = FakeServer(
+		lambda r: menu_types(r) if 'menutype' in r.path else menu_items(r),
+		args.menu_latency, args.menu_errors,
+	)
+	sms_server = FakeServer(twilio_message, args.sms_latency, args.sms_errors)
+	menu_notifier.MENU_ID_URL = f'{menu_server.url}/menutypeController.php/show'
+	menu_notifier.MENU_ITEM_URL = f'{menu_server.url}/graphql'
+
+	import requests
+	sms_session = requests.Session()
+	sms_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=64))
+
+	def send_text(phone, body):
+		r = sms_session.post(f'{sms_server.url}/Messages.json',
+												data={'To': phone, 'Body': body}, timeout=30)
+		r.raise_for_status()
+		return r.json()['sid']
+
+	timer = StageTimer()
+	outbox.send_text = send_text
+	outbox.dispatch = timer.wrap('dispatch', outbox.dispatch)
+	menu_notifier.MenuFetcher.fetch = timer.wrap('menu fetch', menu_notifier.MenuFetcher.fetch)
+	menu_notifier.MenuFetcher.prefetch = timer.wrap('menu prefetch', menu_notifier.MenuFetcher.prefetch)
+	menu_notifier.render_school = timer.wrap('render', menu_notifier.render_school)
+	menu_notifier.iter_subscribers = timer.wrap_iter('db read', menu_notifier.iter_subscribers)
+	outbox.enqueue = timer.wrap('enqueue', outbox.enqueue)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		app = create_app({'DATABASE': os.path.join(tmp, 'bench.sqlite')})
+		with app.app_context():
+			init_db()
+			db = get_db()
+			schools = [f'School {i}' for i in range(args.schools)]
+			db.execute('DELETE FROM menu_source')
+			db.execute('DELETE FROM school')
+			db.executemany('INSERT INTO school (name) VALUES (?)', [(s,) for s in schools])
+			db.executemany(
+				'INSERT INTO menu_source (school, meal, menu_id, long) VALUES (?, ?, ?, ?)',
+				[(s, meal, f'{meal.lower()}-{i % 5}', int(meal == 'LUNCH'))
+					for i, s in enumerate(schools) for meal in ('BREAKFAST', 'LUNCH')],
+			)
+			db.executemany(
+				'INSERT INTO user (username, phone, school) VALUES (?, ?, ?)',
+				[(f'User{i}', f'+1555{i:07d}', schools[i % len(schools)])
+					for i in range(args.users)],
+			)
+			db.commit()
+
+			if args.warm:
+				from menuNotifierApp.schools import get_schools
+				menu_notifier.MenuFetcher().prefetch(
+					[meal for school in get_schools().values() for meal in school.values()],
+					[datetime.now() + timedelta(days=1)],
+				)
+				timer.totals.clear()
+				timer.counts.clear()
+			menu_calls = menu_server.calls
+
+			start = time.perf_counter()
+			summary = menu_notifier.send_messages()
+			duration = time.perf_counter() - start
+
+	menu_server.close()
+	sms_server.close()
+	report = {
+		'users': args.users,
+		'schools': args.schools,
+		'duration': round(duration, 3),
+		'throughput': round(summary.sent / duration, 1) if duration else 0,
+		'sent': summary.sent,
+		'failed': summary.failed,
+		'segments': summary.segments,
+		'send_p50': round(summary.p50, 4),
+		'send_p99': round(summary.p99, 4),
+		'menu_calls': menu_server.calls - menu_calls,
+		'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+		'stages': {stage: {'seconds': round(total, 3), 'calls': timer.counts[stage]}
+								for stage, total in timer.totals.items()},
+	}
+	if args.json:
+		print(json.dumps(report, indent=2))
+		return
+	for key, val in report.items():
+		if key != 'stages':
+			print(f'{key:>12}: {val}')
+	print('      stages:')
+	for stage, val in report['stages'].items():
+		print(f"{stage:>12}: {val['seconds']:.3f}s over {val['calls']} calls")
+
+if __name__ == '__main__':
+	main()
@@ -1,6 +1,5 @@
-import atexit
 import click
-from datetime import datetime
+from datetime import timedelta
 from dotenv import load_dotenv
 from flask import (
   has_request_context, 
@@ -12,15 +11,15 @@ from flask import (
   render_template,
 )
 from flask.logging import default_handler
-from flask_apscheduler import APScheduler
-from flask_apscheduler.utils import CronTrigger
 from flask_bootstrap import Bootstrap5
 from flask_wtf import FlaskForm
 import os
 import logging
 from logging.config import dictConfig
 from logging.handlers import TimedRotatingFileHandler
-from .menu_notifier import send_messages
+from . import tasks
+from .httpcache import render_cached
+from .logqueue import is_queued, queue_handlers
 from wtforms.validators import DataRequired
 from wtforms.fields import (
   EmailField, 
@@ -33,9 +32,7 @@ from .twilio import (
 	twilio_handler,
 )
 
-CRONTAB = os.getenv('MENU_NOTIFIER_CRON', '0 19 * * 0-3,6')
 SCHEDULER = os.getenv('MENU_NOTIFIER_SCHEDULER')
-SCHOOL_START = os.getenv('MENU_NOTIFIER_START', str(datetime.now().date()))
 
 dictConfig({
     'version': 1,
@@ -58,7 +55,8 @@ class RequestFormatter(logging.Formatter):
 		if has_request_context():
 			record.url = request.url
 			record.remote_addr = request.remote_addr
-		else:
+		elif not hasattr(record, 'url'):
+			# Records formatted off-thread keep the fields captured when queued
 			record.url = None
 			record.remote_addr = None
 
@@ -107,17 +105,22 @@ def create_app(test_config=None):
 		except OSError:
 			app.logger.exception('Failed to create instance folder')
 
-	# Add email logging handler
-	twilio_handler.setLevel(logging.ERROR)
-	app.logger.addHandler(twilio_handler)
-	rot_handler = TimedRotatingFileHandler(
-		os.path.join(app.instance_path, 'menuNotifier.log'), 
-		when='midnight',
-		backupCount=6,
-	)
-	rot_handler.setLevel(logging.INFO)
-	rot_handler.setFormatter(formatter)
-	app.logger.addHandler(rot_handler)
+	# app.logger is shared by every app in the process, set it up only once
+	if not is_queued(app.logger):
+		# Add email logging handler
+		twilio_handler.setLevel(logging.ERROR)
+		app.logger.addHandler(twilio_handler)
+		rot_handler = TimedRotatingFileHandler(
+			os.path.join(app.instance_path, 'menuNotifier.log'), 
+			when='midnight',
+			backupCount=6,
+		)
+		rot_handler.setLevel(logging.INFO)
+		rot_handler.setFormatter(formatter)
+		app.logger.addHandler(rot_handler)
+		# Formatting, file rotation and alert delivery happen on a writer thread
+		queue_handlers(app.logger)
+	queue_handlers(logging.getLogger())
 
 	bootstrap = Bootstrap5()
 	bootstrap.init_app(app)
@@ -125,12 +128,24 @@ def create_app(test_config=None):
 	from . import db
 	db.init_app(app)
 
+	from . import cache
+	cache.init_app(app)
+
+	from . import schools
+	schools.init_app(app)
+
+	from . import outbox
+	outbox.init_app(app)
+
 	from . import signup
 	app.register_blueprint(signup.bp)
 
 	from . import policies
 	app.register_blueprint(policies.bp)
 
+	from . import status
+	status.init_app(app)
+
 	@app.route('/')
 	def home():
 		return redirect(url_for('signup.signup'))
@@ -138,72 +153,62 @@ def create_app(test_config=None):
 	@app.route('/contact', methods=('GET', 'POST'))
 	def contact():
 		form = ContactForm()
-		error = None
 		if form.validate_on_submit():
-			try:
-				app.logger.info('Sending contact email')	
-				send_email(
-					subject=f'[User Contact] {form.subject.data}', 
-					body=form.message.data,
-					reply_to=(form.email.data, form.name.data)
-				)
-				form = ContactForm(formdata=None)
-				flash('Message sent!', 'success')
-			except:
-				app.logger.exception('Failed to send user contact message')
-				error = 'Failed to send message, please try again later'
-
-		if error is not None:
-			flash(error, 'error')
+			app.logger.info('Sending contact email')	
+			tasks.submit(
+				send_email,
+				subject=f'[User Contact] {form.subject.data}', 
+				body=form.message.data,
+				reply_to=(form.email.data, form.name.data)
+			)
+			form = ContactForm(formdata=None)
+			flash('Message sent!', 'success')
 		
 		return render_template('contact.html', form=form)
 
+	from . import scheduler
+	scheduler.init_app(app)
+
+	from . import metrics
+	metrics.init_app(app)
+
+	from . import profiling
+	profiling.init_app(app)
+
+	from . import httpcache
+	httpcache.init_app(app)
+
 	if SCHEDULER:
-		scheduler = APScheduler()
-		scheduler.init_app(app)	
-		@scheduler.task(
-			CronTrigger.from_crontab(CRONTAB),
-			id='send_sms',	
-			misfire_grace_time=4500,	
-		)
-		def sens_sms():
-			"""
-			Send notifications Weekdays at 7pm
-			"""
-			try:
-				today = datetime.now().date()
-				if today >= datetime.strptime(SCHOOL_START, '%Y-%m-%d').date():					
-					with app.app_context():
-						app.logger.info('Sending messages')
-						send_messages()
-				else:
-					app.logger.info('School hasn''t started yet, skipping messages')
-			except:
-				app.logger.exception('Failed to send messages')
-
-		app.logger.info(f'Starting scheduler with crontab "{CRONTAB}"')
-		scheduler.start()
-		@atexit.register
-		def close_scheduler():
-			if scheduler.running:
-				app.logger.info('Shutting down the scheduler')
-				scheduler.shutdown()
+		# Every web worker would run the jobs, the worker process runs them once
+		app.logger.warning('MENU_NOTIFIER_SCHEDULER is no longer supported, '
+											 'run the jobs with "flask run-scheduler" instead')
 
 	@click.command('send-sms')
 	@click.argument('msg', nargs=-1)	
-	def send_sms_command(msg=None):
+	@click.option('--weekly', is_flag=True, help='Send next week\'s digest')
+	@click.option('--start', type=click.DateTime(['%Y-%m-%d']), 
+								help='First day of the menu or digest')
+	@click.option('--end', type=click.DateTime(['%Y-%m-%d']), 
+								help='Last day of a digest')
+	def send_sms_command(msg=None, weekly=False, start=None, end=None):
 		"""
 		Send notifications manually
 		"""
+		from .menu_notifier import next_week, send_messages
 		if len(msg) == 0:
 			msg = None
 		elif len(msg) == 1:
 			msg = msg[0]
+		if weekly and start is None:
+			start, end = next_week()
+		elif weekly:
+			end = end or start + timedelta(days=4)
 		try:
 			with app.app_context():
 				app.logger.info('Sending messages manually')
-				send_messages(user_message=msg)
-				click.echo('Messages sent')
+				summary = send_messages(date=start, user_message=msg, until=end)
+				app.logger.info(str(summary))
+				click.echo(f'Messages sent: {summary}')
 		except:
 			app.logger.exception('Failed to send messages')
 
@@ -211,10 +216,10 @@ def create_app(test_config=None):
 
 	@app.errorhandler(404)
 	def page_not_found(e):
-		return render_template('error/404.html'), 404
+		return render_cached('error/404.html', 404)
 
 	@app.errorhandler(500)
 	def internal_server_error(e):
-		return render_template('error/500.html'), 500
+		return render_cached('error/500.html', 500)
 
 	return app
\ No newline at end of file
@@ -0,0 +1,174 @@
+import atexit
+from http_logging.handler import AsyncHttpHandler
+from http_logging.transport import AsyncHttpTransport
+import logging
+import os
+import threading
+from twilio.rest import Client
+from typing import Callable, Dict, Iterable, Optional, List
+from .dispatch import TokenBucket
+from .twilio import APP_NAME, send_email
+
+# Identical alerts within the window are sent as one digest
+ALERT_WINDOW = float(os.getenv('MENU_NOTIFIER_ALERT_WINDOW', '60'))
+ALERTS_PER_HOUR = int(os.getenv('MENU_NOTIFIER_ALERTS_PER_HOUR', '6'))
+# Distinct alerts held for the next digest, the rest are only counted
+MAX_PENDING = int(os.getenv('MENU_NOTIFIER_ALERT_MAX_PENDING', '100'))
+# Outside the app logger, a failed alert must not raise another alert
+logger = logging.getLogger('menu_notifier_alerts')
+
+class AlertAggregator:
+	"""
+	Collects log records, folding identical level and message pairs together,
+	and hands them to send as one digest per window. Digests are capped at
+	per_hour, alerts held back by the cap or by a failed send go out with 
+	the next digest. At most max_pending distinct alerts are held, the rest 
+	are counted and reported as dropped.
+	"""
+	def __init__(self, 
+							send: Callable[[List[dict]], None], 
+							window: float=ALERT_WINDOW, 
+							per_hour: int=ALERTS_PER_HOUR,
+							max_pending: int=MAX_PENDING):
+		self.send = send
+		self.window = window
+		self.bucket = TokenBucket(per_hour / 3600, capacity=per_hour) if per_hour else None
+		self.max_pending = max_pending
+		self.pending: Dict[tuple, dict] = {}
+		self.dropped = 0
+		self.timer = None
+		self.lock = threading.Lock()
+
+	def add(self, logs: Iterable[dict]) -> None:
+		with self.lock:
+			for log in logs:
+				self._hold((log['level']['name'], log['message']), {'log': log, 'count': 1})
+			self._schedule()
+
+	def _hold(self, key: tuple, alert: dict) -> None:
+		if key in self.pending:
+			self.pending[key]['count'] += alert['count']
+		elif len(self.pending) < self.max_pending:
+			self.pending[key] = alert
+		else:
+			self.dropped += alert['count']
+
+	def _schedule(self) -> None:
+		if self.timer is None and (self.pending or self.dropped):
+			self.timer = threading.Timer(self.window, self.flush)
+			self.timer.daemon = True
+			self.timer.start()
+
+	def flush(self, force: bool=False) -> None:
+		with self.lock:
+			self.timer = None
+			if not self.pending and not self.dropped:
+				return
+			if not force and self.bucket is not None and not self.bucket.try_acquire():
+				self._schedule()
+				return
+			pending, self.pending = self.pending, {}
+			dropped, self.dropped = self.dropped, 0
+		alerts = list(pending.values())
+		if dropped:
+			alerts.append({'log': {
+				'level': {'name': 'WARNING'}, 
+				'message': f'{dropped} more alerts dropped, too many were pending',
+			}, 'count': 1})
+		try:
+			self.send(alerts)
+		except Exception:
+			logger.exception(f'Failed to send {len(alerts)} alerts, keeping them for the next digest')
+			with self.lock:
+				for key, alert in pending.items():
+					self._hold(key, alert)
+				self.dropped += dropped
+				if not force:
+					self._schedule()
+
+# Based on tutorial from 
+# https://www.twilio.com/blog/python-error-alerting-twilio-sendgrid
+class TwilioHttpTransport(AsyncHttpTransport):
+	def __init__(
+			self,
+			logger_name: str,
+			twilio_account_sid: Optional[str] = None,
+			twilio_auth_token: Optional[str] = None,
+			twilio_sender_number: Optional[str] = None,
+			alert_phone: Optional[str] = None,
+			alert_email: bool=False,
+			*args,
+			**kwargs,
+	) -> None:
+		self.logger_name = logger_name
+		self.alert_context = f'[{logger_name}] Alert from logger'
+
+		self.twilio_account_sid = twilio_account_sid
+		self.twilio_auth_token = twilio_auth_token
+		self.twilio_sender_number = twilio_sender_number
+
+		self.alert_phone = alert_phone
+		self.alert_email = alert_email
+		self._twilio_client = None
+		self.aggregator = AlertAggregator(self.send_alerts)
+		atexit.register(self.aggregator.flush, force=True)
+		super().__init__(*args, **kwargs)
+
+	@property
+	def twilio_client(self) -> Client:
+		if self._twilio_client is None:
+			self._twilio_client = Client(
+				username=self.twilio_account_sid,
+				password=self.twilio_auth_token,
+			)
+		return self._twilio_client
+
+	def send(self, events: List[bytes], **kwargs) -> None:
+		self.aggregator.add(
+			log 
+			for batch in self._HttpTransport__batches(events) 
+			for log in batch
+		)
+
+	def send_alerts(self, alerts: List[dict]) -> None:
+		if self.alert_phone:
+			self.send_sms_alert(alerts=alerts)
+
+		if self.alert_email:
+			self.send_email_alert(alerts=alerts)
+
+	def send_sms_alert(self, alerts: List[dict]) -> None:
+		sms_logs = ', '.join([
+			f"{self.count_prefix(alert)}{alert['log']['level']['name']}: "
+			f"{alert['log']['message']}"
+			for alert in alerts
+		])
+
+		self.twilio_client.messages.create(
+			body=f'[{self.alert_context}] {sms_logs}',
+			from_=self.twilio_sender_number,
+			to=self.alert_phone,
+		)
+
+	def send_email_alert(self, alerts: List[dict]) -> None:
+		msg = '<hr>'.join([
+			self.count_prefix(alert) + self.build_log_html(alert['log'])
+			for alert in alerts
+		])
+
+		send_email(subject=self.alert_context, body=msg)
+
+	def count_prefix(self, alert: dict) -> str:
+		return f"{alert['count']}x " if alert['count'] > 1 else ''
+
+	def build_log_html(self, log):
+		return '<br>'.join([
+			f'<b>{key}:</b> {val}'
+			for key, val in log.items()
+		])
+
+def alert_handler() -> AsyncHttpHandler:
+	return AsyncHttpHandler(transport_class=TwilioHttpTransport(
+		logger_name=APP_NAME,
+		alert_email=True,
+	))
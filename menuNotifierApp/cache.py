@@ -0,0 +1,167 @@
+import click
+from datetime import datetime
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+from .db import get_db
+
+CACHE_SIZE = int(os.getenv('MENU_NOTIFIER_CACHE_SIZE', '1000'))
+# Product details are kept apart from menus, a district has thousands
+DETAILS_CACHE_SIZE = int(os.getenv('MENU_NOTIFIER_DETAILS_CACHE_SIZE', '5000'))
+
+def cache_get(key: str, stale: bool=False) -> Optional[Any]:
+	"""stale=True also returns expired entries, as a fallback when upstream is down"""
+	db = get_db()
+	now = time.time()
+	entry = db.execute(
+		'SELECT value, expires FROM menu_cache WHERE key = ?',
+		(key,)
+	).fetchone()
+	if entry is None or (entry['expires'] < now and not stale):
+		return None
+	db.execute('UPDATE menu_cache SET accessed = ? WHERE key = ?', (now, key))
+	db.commit()
+	return json.loads(entry['value'])
+
+def cache_set(key: str, value: Any, ttl: int, month: int, year: int) -> None:
+	db = get_db()
+	now = time.time()
+	db.execute(
+		'INSERT OR REPLACE INTO menu_cache (key, month, year, value, expires, accessed)'
+		' VALUES (?, ?, ?, ?, ?, ?)',
+		(key, month, year, json.dumps(value), now + ttl, now),
+	)
+	# Evict least recently used entries beyond the size bound
+	db.execute(
+		'DELETE FROM menu_cache WHERE key NOT IN '
+		'(SELECT key FROM menu_cache ORDER BY accessed DESC LIMIT ?)',
+		(CACHE_SIZE,),
+	)
+	db.commit()
+
+def details_get_many(item_ids: List[str]) -> Dict[str, dict]:
+	"""Cached product details by id, expired entries are left out"""
+	db = get_db()
+	now = time.time()
+	entries = {}
+	# Stay under SQLite's bound parameter limit
+	for start in range(0, len(item_ids), 500):
+		chunk = item_ids[start:start + 500]
+		entries.update((row['id'], json.loads(row['value'])) for row in db.execute(
+			f"SELECT id, value FROM product_cache WHERE id IN ({', '.join('?' * len(chunk))})"
+			' AND expires >= ?',
+			(*chunk, now),
+		))
+	if entries:
+		db.executemany(
+			'UPDATE product_cache SET accessed = ? WHERE id = ?',
+			[(now, item_id) for item_id in entries],
+		)
+		db.commit()
+	return entries
+
+def details_set_many(details: Dict[str, dict], ttl: int) -> None:
+	db = get_db()
+	now = time.time()
+	db.executemany(
+		'INSERT OR REPLACE INTO product_cache (id, value, expires, accessed)'
+		' VALUES (?, ?, ?, ?)',
+		[(item_id, json.dumps(value), now + ttl, now) for item_id, value in details.items()],
+	)
+	db.execute(
+		'DELETE FROM product_cache WHERE id NOT IN '
+		'(SELECT id FROM product_cache ORDER BY accessed DESC LIMIT ?)',
+		(DETAILS_CACHE_SIZE,),
+	)
+	db.commit()
+
+def cache_invalidate(month: int, year: int) -> int:
+	"""Drop a month's cached menus and the messages rendered from them"""
+	db = get_db()
+	cur = db.execute(
+		'DELETE FROM menu_cache WHERE month = ? AND year = ?', 
+		(month, year)
+	)
+	count = cur.rowcount
+	cur = db.execute(
+		'DELETE FROM rendered_message WHERE date LIKE ?', 
+		(f'{year:04d}-{month:02d}-%',)
+	)
+	db.commit()
+	return count + cur.rowcount
+
+def save_rendered(school: str, date: str, body: str) -> None:
+	db = get_db()
+	db.execute(
+		'INSERT OR REPLACE INTO rendered_message (school, date, body, created)'
+		' VALUES (?, ?, ?, ?)',
+		(school, date, body, time.time()),
+	)
+	db.commit()
+
+def discard_rendered(school: str, date: str) -> None:
+	"""Forget a stored message so the send job renders it from live menus"""
+	db = get_db()
+	db.execute('DELETE FROM rendered_message WHERE school = ? AND date = ?', (school, date))
+	db.commit()
+
+def prune_rendered(today: str) -> int:
+	"""Delete messages rendered for dates before today"""
+	db = get_db()
+	cur = db.execute('DELETE FROM rendered_message WHERE date < ?', (today,))
+	db.commit()
+	return cur.rowcount
+
+def load_rendered(date: str) -> Dict[str, str]:
+	"""Prefetched message bodies for a date, by school"""
+	db = get_db()
+	return {row['school']: row['body'] for row in db.execute(
+		'SELECT school, body FROM rendered_message WHERE date = ?', 
+		(date,)
+	)}
+
+def month_option(f):
+	today = datetime.today()
+	f = click.option('--year', type=int, default=today.year, show_default=True)(f)
+	f = click.option('--month', type=click.IntRange(1, 12), default=today.month, 
+									show_default=True)(f)
+	return f
+
+@click.command('prewarm-menus')
+@month_option
+def prewarm_menus_command(month, year):
+	"""Fetch and cache all menus for a month."""
+	from .menu_notifier import MenuFetcher
+	from .schools import get_schools
+	fetcher = MenuFetcher(refresh=True)
+	meal_ids = {meal['id'] for school in get_schools().values() for meal in school.values()}
+	for meal_id in sorted(meal_ids):
+		try:
+			days = fetcher.fetch(meal_id, month, year)
+			click.echo(f'Cached {meal_id} for {month}/{year} ({len(days)} days)')
+		except Exception as ex:
+			click.echo(f'Failed to fetch {meal_id} for {month}/{year}: {ex}')
+
+@click.command('invalidate-menus')
+@month_option
+def invalidate_menus_command(month, year):
+	"""Drop all cached menus for a month."""
+	count = cache_invalidate(month, year)
+	click.echo(f'Removed {count} cached entries for {month}/{year}')
+
+@click.command('prefetch-messages')
+@click.option('--days', type=int, default=None, help='School days to render')
+def prefetch_messages_command(days):
+	"""Fetch menus and store rendered messages for the coming school days."""
+	from .menu_notifier import PREFETCH_DAYS, prefetch_messages
+	missing = prefetch_messages(days=days or PREFETCH_DAYS)
+	if missing:
+		click.echo(f'Menus missing: {", ".join(missing)}')
+	else:
+		click.echo('All menus prefetched')
+
+def init_app(app):
+	app.cli.add_command(prewarm_menus_command)
+	app.cli.add_command(prefetch_messages_command)
+	app.cli.add_command(invalidate_menus_command)
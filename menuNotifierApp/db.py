@@ -1,35 +1,156 @@
 import sqlite3
 import click
 from flask import current_app, g
+import os
+import threading
+from typing import Iterator, List, Optional
+from urllib.request import pathname2url
+from .metrics import metrics
+
+BATCH_SIZE = 500
+# Milliseconds a writer waits on a locked database
+BUSY_TIMEOUT = int(os.getenv('MENU_NOTIFIER_DB_BUSY_TIMEOUT', '5000'))
+# Page cache per connection in KiB
+CACHE_SIZE = int(os.getenv('MENU_NOTIFIER_DB_CACHE_SIZE', '8192'))
+STATEMENT_CACHE = 256
+# Connections are kept per thread and reused across app contexts
+_local = threading.local()
+# Columns added after their table was first released, as (table, column, 
+# definition). ADD COLUMN needs a default for NOT NULL columns.
+COLUMNS = [
+	# Rows from before expiry tracking count as already expired
+	('retries', 'expires', 'REAL NOT NULL DEFAULT 0'),
+	('user', 'delivery', 
+		"TEXT NOT NULL DEFAULT 'daily' CHECK (delivery IN ('daily', 'weekly'))"),
+	('school', 'timezone', 'TEXT'),
+	('school', 'send_time', 'TEXT'),
+	('school', 'start_date', 'TEXT'),
+	('school', 'end_date', 'TEXT'),
+	('school', 'send_window', 'INTEGER NOT NULL DEFAULT 0'),
+	('outbox', 'not_before', 'REAL NOT NULL DEFAULT 0'),
+	('outbox', 'delivery', 'TEXT'),
+	('outbox', 'error_code', 'TEXT'),
+	('user', 'failures', 'INTEGER NOT NULL DEFAULT 0'),
+	('user', 'suspended', 'REAL'),
+	('retries', 'code_status', 'TEXT'),
+	('retries', 'code_updated', 'REAL'),
+]
+
+def connect(database: str, readonly: bool=False) -> sqlite3.Connection:
+	if readonly:
+		database = f'file:{pathname2url(database)}?mode=ro'
+	conn = sqlite3.connect(
+		database,
+		detect_types=sqlite3.PARSE_DECLTYPES,
+		timeout=BUSY_TIMEOUT / 1000,
+		cached_statements=STATEMENT_CACHE,
+		uri=readonly,
+	)
+	conn.row_factory = sqlite3.Row
+	if not readonly:
+		# Readers don't block writers and vice versa, persisted in the file
+		conn.execute('PRAGMA journal_mode = WAL')
+	conn.execute('PRAGMA synchronous = NORMAL')
+	conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+	conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE}')
+	return conn
+
+def pooled_connection(database: str, readonly: bool=False) -> sqlite3.Connection:
+	conns = _local.__dict__.setdefault('conns', {})
+	key = (database, readonly)
+	if key not in conns:
+		conns[key] = connect(database, readonly=readonly)
+	return conns[key]
 
 def get_db():
 	if 'db' not in g:
-		g.db = sqlite3.connect(
-			current_app.config['DATABASE'],
-			detect_types=sqlite3.PARSE_DECLTYPES
-		)
-		g.db.row_factory = sqlite3.Row
+		g.db = pooled_connection(current_app.config['DATABASE'])
 
 	return g.db
 
+def get_readonly_db():
+	"""Read-only connection for bulk scans that shouldn't contend with writers"""
+	if 'readonly_db' not in g:
+		try:
+			g.readonly_db = pooled_connection(current_app.config['DATABASE'], readonly=True)
+		except sqlite3.OperationalError:
+			# Database file not created yet
+			g.readonly_db = get_db()
+
+	return g.readonly_db
+
 def close_db(e=None):
-	db = g.pop('db', None)
+	for name in ('db', 'readonly_db'):
+		db = g.pop(name, None)
 
-	if db is not None:
-		db.close()
+		# Connection stays open for reuse, drop any unfinished transaction
+		if db is not None and db.in_transaction:
+			db.rollback()
 
-def init_db():
+def iter_subscribers(school: str, 
+										delivery: Optional[str]=None,
+										batch_size: int=BATCH_SIZE) -> Iterator[sqlite3.Row]:
+	"""
+	Stream (username, phone) rows for a school in keyset-paginated batches, 
+	optionally only those with the given delivery frequency. Suspended 
+	numbers are skipped.
+	"""
+	db = get_readonly_db()
+	query = 'SELECT id, username, phone FROM user WHERE school = ? AND suspended IS NULL'
+	params = [school]
+	if delivery is not None:
+		query += ' AND delivery = ?'
+		params.append(delivery)
+	query += ' AND id > ? ORDER BY id LIMIT ?'
+	last_id = 0
+	while True:
+		with metrics.timer('db_query', query='subscribers'):
+			rows = db.execute(query, (*params, last_id, batch_size)).fetchall()
+		yield from rows
+		if len(rows) < batch_size:
+			break
+		last_id = rows[-1]['id']
+
+def migrate() -> List[str]:
+	"""
+	Bring the database up to date without touching existing data, safe to 
+	run on every deploy. Returns the columns that were added.
+	"""
 	db = get_db()
+	added = []
+	tables = {row['name'] for row in db.execute(
+		"SELECT name FROM sqlite_master WHERE type = 'table'"
+	)}
+	# Before the schema script, its indexes may cover the new columns
+	for table, column, definition in COLUMNS:
+		if table not in tables:
+			continue
+		columns = {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+		if column not in columns:
+			db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+			added.append(f'{table}.{column}')
+	db.commit()
 
 	with current_app.open_resource('schema.sql') as f:
 		db.executescript(f.read().decode('utf8'))
+	return added
+
+def init_db():
+	migrate()
 
 @click.command('init-db')
 def init_db_command():
-	"""Clear the existing data and create new tables."""
+	"""Create missing tables, existing data is kept."""
 	init_db()
 	click.echo('Initialized the database.')
 
+@click.command('migrate')
+def migrate_command():
+	"""Add tables and columns introduced since the database was created."""
+	added = migrate()
+	click.echo(f"Database up to date{', added ' + ', '.join(added) if added else ''}.")
+
 def init_app(app):
 	app.teardown_appcontext(close_db)
-	app.cli.add_command(init_db_command)
\ No newline at end of file
+	app.cli.add_command(init_db_command)
+	app.cli.add_command(migrate_command)
\ No newline at end of file
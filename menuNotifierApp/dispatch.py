@@ -0,0 +1,154 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import os
+import threading
+import time
+from typing import Any, Callable, Hashable, Iterable, List, Optional, Tuple
+from .metrics import metrics
+
+CONCURRENCY = int(os.getenv('MENU_NOTIFIER_SEND_CONCURRENCY', '8'))
+# Messages per second, should match the messaging service throughput
+RATE = float(os.getenv('MENU_NOTIFIER_SEND_RATE', '10'))
+_bucket = None
+_bucket_lock = threading.Lock()
+
+class TokenBucket:
+	def __init__(self, rate: float, capacity: Optional[float]=None):
+		self.rate = rate
+		self.capacity = capacity or max(rate, 1)
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def _refill(self) -> None:
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def try_acquire(self) -> bool:
+		with self.lock:
+			self._refill()
+			if self.tokens >= 1:
+				self.tokens -= 1
+				return True
+			return False
+
+	def acquire(self) -> None:
+		while True:
+			with self.lock:
+				self._refill()
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait_time = (1 - self.tokens) / self.rate
+			time.sleep(wait_time)
+
+def shared_bucket() -> Optional[TokenBucket]:
+	"""
+	The process wide RATE limit, shared by every drain so concurrent school 
+	jobs don't each send at the full rate. None when RATE is 0.
+	"""
+	global _bucket
+	with _bucket_lock:
+		if _bucket is None and RATE:
+			_bucket = TokenBucket(RATE)
+	return _bucket
+
+@dataclass
+class DispatchSummary:
+	sent: int = 0
+	failed: int = 0
+	duration: float = 0
+	segments: int = 0
+	latencies: List[float] = field(default_factory=list)
+	errors: List[Tuple[Hashable, str]] = field(default_factory=list)
+
+	def percentile(self, p: float) -> float:
+		if not self.latencies:
+			return 0
+		latencies = sorted(self.latencies)
+		return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+	@property
+	def p50(self) -> float:
+		return self.percentile(50)
+
+	@property
+	def p99(self) -> float:
+		return self.percentile(99)
+
+	def merge(self, other: 'DispatchSummary') -> None:
+		self.sent += other.sent
+		self.failed += other.failed
+		self.duration += other.duration
+		self.segments += other.segments
+		self.latencies.extend(other.latencies)
+		self.errors.extend(other.errors)
+
+	def __str__(self) -> str:
+		segments = f', {self.segments} segments' if self.segments else ''
+		return (f'Sent {self.sent}, failed {self.failed} in {self.duration:.2f}s '
+						f'(p50 {self.p50:.3f}s, p99 {self.p99:.3f}s{segments})')
+
+def _timed_send(send: Callable, phone: str, body: str) -> Tuple[float, Any]:
+	start = time.perf_counter()
+	try:
+		result = send(phone=phone, body=body)
+	except Exception as ex:
+		ex.latency = time.perf_counter() - start
+		metrics.observe('send_text', ex.latency, status='error')
+		raise
+	latency = time.perf_counter() - start
+	metrics.observe('send_text', latency, status='ok')
+	return latency, result
+
+def dispatch(messages: Iterable[Tuple[Hashable, str, str]],
+						send: Callable,
+						concurrency: int=CONCURRENCY,
+						rate: float=RATE,
+						on_result: Optional[Callable]=None,
+						bucket: Optional[TokenBucket]=None) -> DispatchSummary:
+	"""
+	Send (key, phone, body) messages through a bounded worker pool. Failures
+	are collected in the summary, on_result(key, result, error) is called
+	from the calling thread as each message completes. Pass a bucket to 
+	share one rate limit across several calls.
+	"""
+	summary = DispatchSummary()
+	if bucket is None and rate:
+		bucket = TokenBucket(rate)
+	start = time.perf_counter()
+	pending = {}
+
+	def collect(done):
+		for future in done:
+			key = pending.pop(future)
+			try:
+				latency, result = future.result()
+			except Exception as ex:
+				summary.failed += 1
+				summary.errors.append((key, str(ex)))
+				summary.latencies.append(getattr(ex, 'latency', 0))
+				if on_result is not None:
+					on_result(key, None, ex)
+			else:
+				summary.sent += 1
+				summary.latencies.append(latency)
+				if on_result is not None:
+					on_result(key, result, None)
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for key, phone, body in messages:
+			# Keep the number of queued messages bounded
+			if len(pending) >= concurrency * 2:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				collect(done)
+			if bucket is not None:
+				bucket.acquire()
+			pending[executor.submit(_timed_send, send, phone, body)] = key
+		while pending:
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			collect(done)
+
+	summary.duration = time.perf_counter() - start
+	return summary
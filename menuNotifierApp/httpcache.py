@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+from flask import (
+	current_app,
+	make_response,
+	render_template,
+	request,
+	session,
+)
+import hashlib
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+# Browsers may reuse static pages this long before revalidating with the ETag
+PAGE_MAX_AGE = int(os.getenv('MENU_NOTIFIER_PAGE_MAX_AGE', '300'))
+# Static URLs carry a content hash, so they can be cached for good
+STATIC_MAX_AGE = int(os.getenv('MENU_NOTIFIER_STATIC_MAX_AGE', str(365*24*3600)))
+_pages: Dict[tuple, Tuple[bytes, str]] = {}
+_hashes: Dict[str, Tuple[float, str]] = {}
+_mtime: Optional[float] = None
+_lock = threading.Lock()
+
+def templates_mtime() -> float:
+	"""
+	Newest template modification time, checked once per process unless
+	templates are auto reloaded
+	"""
+	global _mtime
+	if _mtime is not None and not current_app.jinja_env.auto_reload:
+		return _mtime
+	folder = os.path.join(current_app.root_path, current_app.template_folder)
+	_mtime = max(
+		os.path.getmtime(os.path.join(root, name))
+		for root, _, files in os.walk(folder) for name in files
+	)
+	return _mtime
+
+def render_cached(template: str, status: int=200):
+	"""
+	render_template for pages whose output only changes with the templates,
+	served from memory with ETag and Last-Modified validation
+	"""
+	# Only touch the session when there is one, reading it adds Vary: Cookie
+	cookie = current_app.config['SESSION_COOKIE_NAME']
+	if cookie in request.cookies and session.get('_flashes'):
+		# Flashed messages are rendered into the page once
+		return render_template(template), status
+	mtime = templates_mtime()
+	key = (request.endpoint, template, mtime)
+	with _lock:
+		page = _pages.get(key)
+	if page is None:
+		body = render_template(template).encode()
+		page = (body, hashlib.sha1(body).hexdigest())
+		with _lock:
+			_pages[key] = page
+	body, etag = page
+	response = make_response(body, status)
+	if status == 200:
+		response.set_etag(etag)
+		response.last_modified = datetime.fromtimestamp(mtime, timezone.utc)
+		response.cache_control.public = True
+		response.cache_control.max_age = PAGE_MAX_AGE
+		response.make_conditional(request)
+	return response
+
+def static_hash(filename: str) -> Optional[str]:
+	path = os.path.join(current_app.static_folder, filename)
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		return None
+	cached = _hashes.get(filename)
+	if cached is None or cached[0] != mtime:
+		with open(path, 'rb') as f:
+			cached = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+		_hashes[filename] = cached
+	return cached[1]
+
+def add_static_hash(endpoint: str, values: dict) -> None:
+	if endpoint == 'static' and 'filename' in values and 'v' not in values:
+		version = static_hash(values['filename'])
+		if version is not None:
+			values['v'] = version
+
+def cache_static(response):
+	if request.endpoint == 'static' and 'v' in request.args and response.status_code == 200:
+		response.cache_control.no_cache = None
+		response.cache_control.public = True
+		response.cache_control.max_age = STATIC_MAX_AGE
+		response.cache_control.immutable = True
+	return response
+
+def init_app(app):
+	app.url_defaults(add_static_hash)
+	app.after_request(cache_static)
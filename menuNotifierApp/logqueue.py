@@ -0,0 +1,72 @@
+import atexit
+import copy
+from flask import has_request_context, request
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import sys
+from .metrics import metrics
+
+# Records held for the writer thread, beyond this they are dropped and counted
+QUEUE_SIZE = int(os.getenv('MENU_NOTIFIER_LOG_QUEUE_SIZE', '10000'))
+
+class BoundedQueueHandler(QueueHandler):
+	"""
+	Hands records to a QueueListener without blocking the logging thread,
+	request fields are captured here since the listener has no request context
+	"""
+	def __init__(self, records: queue.Queue):
+		super().__init__(records)
+		self.dropped = 0
+
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		# Freeze the message, arguments may change before the writer gets to them.
+		# Formatting, including tracebacks, is left to the writer thread.
+		record = copy.copy(record)
+		record.msg = record.getMessage()
+		record.args = None
+		if has_request_context():
+			record.url = request.url
+			record.remote_addr = request.remote_addr
+		return record
+
+	def enqueue(self, record: logging.LogRecord) -> None:
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+			metrics.inc('log_records_dropped')
+
+class FlushingQueueListener(QueueListener):
+	def enqueue_sentinel(self) -> None:
+		# Wait for room so everything already queued is written before stopping
+		self.queue.put(self._sentinel)
+
+def is_queued(logger: logging.Logger) -> bool:
+	return any(isinstance(handler, BoundedQueueHandler) for handler in logger.handlers)
+
+def queue_handlers(logger: logging.Logger, size: int=QUEUE_SIZE) -> None:
+	"""
+	Move logger's handlers behind a bounded queue drained by a background
+	thread, which is flushed and stopped at exit
+	"""
+	if is_queued(logger):
+		return
+	handlers = list(logger.handlers)
+	if not handlers:
+		return
+	records = queue.Queue(size)
+	queue_handler = BoundedQueueHandler(records)
+	listener = FlushingQueueListener(records, *handlers, respect_handler_level=True)
+	for handler in handlers:
+		logger.removeHandler(handler)
+	logger.addHandler(queue_handler)
+	listener.start()
+
+	@atexit.register
+	def stop_listener():
+		listener.stop()
+		if queue_handler.dropped:
+			sys.stderr.write(f'{queue_handler.dropped} {logger.name or "root"} '
+											 'log records dropped, queue was full\n')
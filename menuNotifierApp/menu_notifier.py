@@ -1,35 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+import hashlib
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from retry import retry
-from typing import Iterable, Optional
-from .db import get_db
-from .twilio import send_text
-
-MENU_ID = {
-	'McAuliffe': {
-		'BREAKFAST': {
-			'id': '6136d437534a13f81e174a81',
-			'long': False,
-		},
-		'LUNCH': {
-			'id': '671fda48e96f1e3ea01554f7',
-			'long': True,
-		},
-	},
-	'CUSD': {
-		'BREAKFAST': {
-			'id': '6136d437534a13f81e174a81',
-			'long': False,
-		},
-		'LUNCH': {
-			'id': '55a02d4deabc88225e8b473f',
-			'long': True,
-		},
-	},
-}
+import threading
+import time
+from urllib.parse import urlsplit
+from flask import current_app, has_app_context
+import logging
+from typing import Dict, Iterable, List, Optional
+from .cache import (
+	cache_get,
+	cache_set,
+	details_get_many,
+	details_set_many,
+	discard_rendered,
+	load_rendered,
+	prune_rendered,
+	save_rendered,
+)
+from .db import iter_subscribers
+from .dispatch import DispatchSummary
+from .metrics import metrics, RetryCounter
+from . import outbox
+from .render import MAX_SEGMENTS, NAME_ALLOWANCE, MessageTemplate
+from .schools import active_schools, get_schedule
+
+logger = logging.getLogger(__name__)
+
 MENU_ID_URL = 'https://www.schoolnutritionandfitness.com/webmenus2/api/menutypeController.php/show'
 MENU_ITEM_URL = 'https://api.isitesoftware.com/graphql'
+# Connect and read timeouts in seconds
+HTTP_TIMEOUT = (
+	float(os.getenv('MENU_NOTIFIER_CONNECT_TIMEOUT', '5')),
+	float(os.getenv('MENU_NOTIFIER_READ_TIMEOUT', '30')),
+)
+# Keep-alive connections per upstream host
+HTTP_POOL_SIZE = {
+	MENU_ID_URL: int(os.getenv('MENU_NOTIFIER_MENU_ID_POOL', '4')),
+	MENU_ITEM_URL: int(os.getenv('MENU_NOTIFIER_MENU_ITEM_POOL', '4')),
+}
+# Concurrent upstream calls for a cold menu fetch, and the cap per host
+FETCH_WORKERS = int(os.getenv('MENU_NOTIFIER_FETCH_WORKERS', '8'))
+HOST_CONCURRENCY = int(os.getenv('MENU_NOTIFIER_HOST_CONCURRENCY', '4'))
+# Seconds the prefetch stage waits before leaving stragglers to gen_message
+FETCH_DEADLINE = float(os.getenv('MENU_NOTIFIER_FETCH_DEADLINE', '60'))
+# Consecutive failures that open a host's circuit, and seconds before a probe
+BREAKER_FAILURES = int(os.getenv('MENU_NOTIFIER_BREAKER_FAILURES', '3'))
+BREAKER_COOLDOWN = float(os.getenv('MENU_NOTIFIER_BREAKER_COOLDOWN', '60'))
+# Monthly menus rarely change once published
+CACHE_ID_TTL = int(os.getenv('MENU_NOTIFIER_CACHE_ID_TTL', str(30*24*3600)))
+CACHE_ITEMS_TTL = int(os.getenv('MENU_NOTIFIER_CACHE_ITEMS_TTL', str(7*24*3600)))
+# Enrich menu items with full product details (image, description)
+ITEM_DETAILS = os.getenv('MENU_NOTIFIER_ITEM_DETAILS')
+# Products per aliased GraphQL details query
+DETAILS_CHUNK = int(os.getenv('MENU_NOTIFIER_DETAILS_CHUNK', '25'))
+# School days ahead the prefetch job renders
+PREFETCH_DAYS = int(os.getenv('MENU_NOTIFIER_PREFETCH_DAYS', '5'))
+# Used when rendering ahead of time, before the send time greeting is known
+LONGEST_GREETING = 'Good Afternoon'
 base = os.path.dirname(os.path.realpath(__file__))
 # Avoid being flagged as bot
 PROXIES = None
@@ -41,6 +72,99 @@ if PROXY is not None and PROXY_AUTH is not None:
 		'https': f'http://{PROXY_AUTH}@{PROXY}'
 	}
 
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+_breakers = {}
+
+class CircuitOpen(Exception):
+	pass
+
+class CircuitBreaker:
+	"""
+	Fails calls to a host fast after failures consecutive errors, letting a 
+	single probe through once cooldown seconds have passed
+	"""
+	def __init__(self, failures: int=BREAKER_FAILURES, cooldown: float=BREAKER_COOLDOWN):
+		self.failures = failures
+		self.cooldown = cooldown
+		self.errors = 0
+		self.opened = None
+		self.lock = threading.Lock()
+
+	def allow(self) -> bool:
+		with self.lock:
+			if self.opened is None:
+				return True
+			if time.monotonic() - self.opened >= self.cooldown:
+				# Half open, the next failure re-opens immediately
+				self.opened = time.monotonic()
+				return True
+			return False
+
+	def record(self, ok: bool) -> None:
+		with self.lock:
+			if ok:
+				self.errors = 0
+				self.opened = None
+				return
+			self.errors += 1
+			if self.errors >= self.failures:
+				self.opened = time.monotonic()
+
+def get_session() -> requests.Session:
+	"""
+	Process wide session so upstream calls reuse pooled keep-alive
+	connections (and proxy tunnels) instead of reconnecting per call
+	"""
+	global _session
+	with _session_lock:
+		if _session is None:
+			session = requests.Session()
+			for url, size in HTTP_POOL_SIZE.items():
+				parts = urlsplit(url)
+				# No transport retries, MenuFetcher.load's @retry is the only layer
+				session.mount(
+					f'{parts.scheme}://{parts.netloc}/',
+					HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=0),
+				)
+			if PROXIES is not None:
+				session.proxies.update(PROXIES)
+			_session = session
+	return _session
+
+def host_slot(host: str) -> threading.BoundedSemaphore:
+	with _session_lock:
+		if host not in _host_slots:
+			_host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+		return _host_slots[host]
+
+def get_breaker(host: str) -> CircuitBreaker:
+	with _session_lock:
+		if host not in _breakers:
+			_breakers[host] = CircuitBreaker()
+		return _breakers[host]
+
+def http_get(url: str, params: dict) -> requests.Response:
+	host = urlsplit(url).netloc
+	breaker = get_breaker(host)
+	if not breaker.allow():
+		metrics.inc('menu_circuit_open', host=host)
+		raise CircuitOpen(f'Circuit open for {host}')
+	with host_slot(host), metrics.timer('menu_http', host=host):
+		try:
+			r = get_session().get(url, params=params, timeout=HTTP_TIMEOUT)
+		except (requests.ConnectionError, requests.Timeout):
+			metrics.inc('menu_http_errors', host=host)
+			breaker.record(False)
+			raise
+	# Other 4xx, like a 404 for a month not yet published, mean the host is up
+	breaker.record(r.status_code < 500 and r.status_code != 429)
+	if not r.ok:
+		metrics.inc('menu_http_errors', host=host)
+	r.raise_for_status()
+	return r
+
 def suffix(d: int) -> str:
 	return 'th' if 11 <= d <= 13 else {1: 'st', 2: 'nd', 3: 'rd'}.get(d % 10, 'th')
 
@@ -67,8 +191,7 @@ def get_menu_id(meal_id: str,
 	month = month or today.month
 	year = year or today.year
 	payload = {'_id': meal_id}
-	r = requests.get(MENU_ID_URL, params=payload, proxies=PROXIES)
-	r.raise_for_status()
+	r = http_get(MENU_ID_URL, params=payload)
 	menus = r.json()
 	if (menus is None) or ('menus' not in menus):
 		raise ValueError('No menu data retrieved')
@@ -79,43 +202,236 @@ def get_menu_id(meal_id: str,
 	
 	return menu_id
 
-def get_menu_items(menu_id: str, day: Optional[int]=None) -> Iterable[dict]:
-	today = datetime.today()
-	day = day or today.day
+def get_month_items(menu_id: str) -> Dict[int, List[dict]]:
 	query = ('{menu(id:"' + menu_id + '") {id month year items{day product{id ' +
 						'name long_description category}}}}')
 	payload = {'query': query}
-	r = requests.get(MENU_ITEM_URL, params=payload, proxies=PROXIES)
-	r.raise_for_status()
+	r = http_get(MENU_ITEM_URL, params=payload)
 	items = r.json()
 	if (items is None) or ('data' not in items):
 		raise ValueError('No menu item data retrieved')
-	options = [x['product'] for x in items['data']['menu']['items'] if 
-							x['day'] == day and x['product']['category'] != 'Ancillary'
-							and x['product']['name'] != 'None']
-	return options
+	days = {}
+	for x in items['data']['menu']['items']:
+		if x['product']['category'] != 'Ancillary' and x['product']['name'] != 'None':
+			days.setdefault(x['day'], []).append(x['product'])
+	return days
+
+def get_menu_items(menu_id: str, day: Optional[int]=None) -> Iterable[dict]:
+	today = datetime.today()
+	day = day or today.day
+	return get_month_items(menu_id).get(day, [])
+
+def fetch_month(meal_id: str, 
+								month: int, 
+								year: int, 
+								menu_id: Optional[str]=None) -> tuple:
+	"""Upstream only, safe to run off the app context thread"""
+	menu_id = menu_id or get_menu_id(meal_id, month=month, year=year)
+	return menu_id, get_month_items(menu_id)
+
+def get_items_details(item_ids: Iterable[str],
+											chunk_size: int=DETAILS_CHUNK) -> Dict[str, dict]:
+	"""
+	Product details for many ids, fetched chunk_size at a time with one
+	aliased GraphQL query per chunk
+	"""
+	item_ids = list(dict.fromkeys(item_ids))
+	details = {}
+	for start in range(0, len(item_ids), chunk_size):
+		chunk = item_ids[start:start + chunk_size]
+		query = '{' + ' '.join(
+			f'p{n}:product(id:"{item_id}") {{id name image_url1 long_description}}'
+			for n, item_id in enumerate(chunk)
+		) + '}'
+		payload = {'query': query}
+		r = http_get(MENU_ITEM_URL, params=payload)
+		items = r.json()
+		if (items is None) or ('data' not in items):
+			raise ValueError('No item data retrieved')
+		for n, item_id in enumerate(chunk):
+			if items['data'].get(f'p{n}'):
+				details[item_id] = items['data'][f'p{n}']
+	return details
+
+class MenuFetcher:
+	"""
+	Run-scoped menu store, each (meal_id, month, year) is fetched once and
+	every school and day sharing it is served from the parsed month
+	"""
+	def __init__(self, refresh: bool=False):
+		self.menus = {}
+		self.details = {}
+		# (meal_id, month, year) served from expired cache entries
+		self.stale = set()
+		# (meal_id, month, year) that could not be fetched, with the error
+		self.failed: Dict[tuple, Exception] = {}
+		# Persistent cache lives in the app database
+		self.use_cache = has_app_context()
+		self.refresh = refresh
+
+	def cached(self, key: str, fetch, ttl: int, month: int, year: int):
+		if not self.use_cache:
+			return fetch()
+		value = None if self.refresh else cache_get(key)
+		if value is None:
+			value = fetch()
+			cache_set(key, value, ttl=ttl, month=month, year=year)
+		return value
+
+	# An open circuit is not worth retrying
+	@retry(exceptions=(requests.RequestException, ValueError, KeyError, TypeError), 
+				tries=3, delay=2, backoff=2, logger=RetryCounter('menu_retries', logger))
+	def load(self, meal_id: str, month: int, year: int) -> dict:
+		menu_id = self.cached(
+			f'menu_id:{meal_id}:{year}-{month:02d}',
+			lambda: get_menu_id(meal_id, month=month, year=year),
+			ttl=CACHE_ID_TTL, month=month, year=year,
+		)
+		return self.cached(
+			f'menu_items:{menu_id}',
+			lambda: get_month_items(menu_id),
+			ttl=CACHE_ITEMS_TTL, month=month, year=year,
+		)
+
+	def fetch(self, meal_id: str, month: int, year: int) -> Dict[int, List[dict]]:
+		"""
+		A month's items by day. Failures are remembered for the run, schools 
+		sharing the menu get the same error without another upstream call
+		"""
+		key = (meal_id, month, year)
+		if key in self.failed:
+			raise self.failed[key]
+		if key not in self.menus:
+			try:
+				days = self.load(meal_id, month, year)
+			except Exception as ex:
+				days = self.fallback(meal_id, month, year)
+				if days is None:
+					self.failed[key] = ex
+					raise
+				logger.warning(f'Serving stale menu {meal_id} for {year}-{month:02d}')
+				metrics.inc('menu_stale')
+				self.stale.add(key)
+			# JSON round trip turns day keys into strings
+			self.menus[key] = {int(day): items for day, items in days.items()}
+		return self.menus[key]
+
+	def fallback(self, meal_id: str, month: int, year: int) -> Optional[dict]:
+		"""Last successfully parsed month, however old"""
+		# A refresh that falls back hasn't refreshed anything
+		if not self.use_cache or self.refresh:
+			return None
+		menu_id = cache_get(f'menu_id:{meal_id}:{year}-{month:02d}', stale=True)
+		return menu_id and cache_get(f'menu_items:{menu_id}', stale=True)
+
+	def stale_menus(self, schools: Dict[str, Dict[str, dict]]) -> List[str]:
+		meal_ids = {meal_id for meal_id, _, _ in self.stale}
+		return [f'{school} {meal.title()}' for school, sources in schools.items() 
+						for meal, source in sources.items() if source['id'] in meal_ids]
+
+	def lookup(self, key: str):
+		if not self.use_cache or self.refresh:
+			return None
+		return cache_get(key)
+
+	def prefetch(self, 
+							meals: Iterable[dict], 
+							dates: Iterable[datetime], 
+							deadline: float=FETCH_DEADLINE) -> None:
+		"""
+		Resolve every uncached month concurrently, cache reads and writes stay 
+		on this thread and only the upstream calls run in the pool
+		"""
+		keys = {(meal['id'], date.month, date.year) for meal in meals for date in dates}
+		pending = {}
+		for key in keys - self.menus.keys():
+			meal_id, month, year = key
+			menu_id = self.lookup(f'menu_id:{meal_id}:{year}-{month:02d}')
+			days = menu_id and self.lookup(f'menu_items:{menu_id}')
+			if days is None:
+				pending[key] = menu_id
+			else:
+				self.menus[key] = {int(day): items for day, items in days.items()}
+		if not pending:
+			return
+		with metrics.timer('menu_prefetch'):
+			executor = ThreadPoolExecutor(
+				max_workers=min(FETCH_WORKERS, len(pending)), 
+				thread_name_prefix='menu-fetch',
+			)
+			futures = {
+				executor.submit(fetch_month, *key, menu_id): key 
+				for key, menu_id in pending.items()
+			}
+			done, not_done = wait(futures, timeout=deadline)
+			executor.shutdown(wait=False, cancel_futures=True)
+		if not_done:
+			logger.warning(f'{len(not_done)} menus not fetched within {deadline}s')
+		for future in done:
+			meal_id, month, year = key = futures[future]
+			try:
+				menu_id, days = future.result()
+			except Exception:
+				# Left for gen_message to retry
+				continue
+			if self.use_cache:
+				cache_set(f'menu_id:{meal_id}:{year}-{month:02d}', menu_id, 
+									ttl=CACHE_ID_TTL, month=month, year=year)
+				cache_set(f'menu_items:{menu_id}', days, 
+									ttl=CACHE_ITEMS_TTL, month=month, year=year)
+			self.menus[key] = days
+
+	def get_items(self, meal_id: str, date: datetime) -> List[dict]:
+		return self.fetch(meal_id, date.month, date.year).get(date.day, [])
+
+	def get_details(self, item_ids: Iterable[str]) -> Dict[str, dict]:
+		"""Product details by id, only uncached ids go upstream in one batch"""
+		item_ids = [item_id for item_id in item_ids if item_id not in self.details]
+		if item_ids and self.use_cache and not self.refresh:
+			self.details.update(details_get_many(item_ids))
+			item_ids = [item_id for item_id in item_ids if item_id not in self.details]
+		if item_ids:
+			details = get_items_details(item_ids)
+			self.details.update(details)
+			if self.use_cache:
+				details_set_many(details, ttl=CACHE_ITEMS_TTL)
+		return self.details
 
 def get_item_details(item_id: str) -> dict:
-	query = '{product(id:"' + item_id + '") {id name image_url1 long_description}}'
-	payload = {'query': query}
-	r = requests.get(MENU_ITEM_URL, params=payload, proxies=PROXIES)
-	r.raise_for_status()
-	item = r.json()
-	if (item is None) or ('data' not in item):
+	details = get_items_details([item_id])
+	if item_id not in details:
 		raise ValueError('No item data retrieved')
-	return item['data']['product']
+	return details[item_id]
+
+def get_meal_items(meal: dict, date: datetime, fetcher: MenuFetcher) -> List[dict]:
+	items = fetcher.get_items(meal['id'], date)
+	if ITEM_DETAILS and items:
+		try:
+			details = fetcher.get_details([item['id'] for item in items])
+		except Exception:
+			# The menu already has names and descriptions, send it without extras
+			logger.warning(f'Item details unavailable for {meal["id"]}', exc_info=True)
+			metrics.inc('menu_details_errors')
+			details = {}
+		items = [{**item, **details.get(item['id'], {})} for item in items]
+	return items
+
+def shorten(desc: str, limit: Optional[int]=None) -> str:
+	if limit is None or len(desc) <= limit:
+		return desc
+	return desc[:limit].rstrip() + '...'
 
-@retry(tries=3, delay=2, backoff=2)
-def gen_message(meal: dict, date: Optional[datetime]=None) -> str:	
+def format_meal(meal: dict, 
+								items: Iterable[dict], 
+								desc_limit: Optional[int]=None) -> List[str]:
 	msg = []
-	date = date or datetime.now()
-	menu_id = get_menu_id(meal['id'], month=date.month, year=date.year)
-	items = get_menu_items(menu_id, day=date.day)
 	for item in items:
-		# item_details = get_item_details(item['id'])
-		if meal['long']:
+		if meal['long'] and desc_limit != 0:
 			desc = item['long_description'].split('\n')[0] if item['long_description'] else ''
-			msg.append(f"{item['name']}: {desc}")
+			msg.append(f"{item['name']}: {shorten(desc, desc_limit)}")
+			msg.append('OR')
+		elif meal['long']:
+			msg.append(item['name'])
 			msg.append('OR')
 		else:
 			msg.append(f"{item['name']}, ")
@@ -130,40 +446,281 @@ def gen_message(meal: dict, date: Optional[datetime]=None) -> str:
 	
 	return msg
 
-def send_messages(date: Optional[datetime]=None, user_message: Optional[str]=None):
+def gen_message(meal: dict, 
+								date: Optional[datetime]=None, 
+								fetcher: Optional[MenuFetcher]=None,
+								desc_limit: Optional[int]=None) -> List[str]:	
+	date = date or datetime.now()
+	fetcher = fetcher or MenuFetcher()
+	return format_meal(meal, get_meal_items(meal, date, fetcher), desc_limit)
+
+def gen_school_body(school: str, 
+										date_str: str, 
+										meal_items: Dict[str, tuple], 
+										desc_limit: Optional[int]=None) -> List[str]:
+	msg = []
+	for meal, (source, items) in meal_items.items():
+		meal_msg = format_meal(source, items, desc_limit)
+		if meal_msg:
+			prefix = f'{meal} option'
+			prefix += 's are:' if len(meal_msg) > 1 else ' is:'
+			msg.append(prefix)
+			msg.extend(meal_msg)
+			msg.append('')
+	if msg:		
+		msg = [f'{school} meal options for {date_str}', ''] + msg + ['Have a nice day!']
+	return msg
+
+def render_school(school: str, 
+									date_str: str, 
+									meal_items: Dict[str, tuple], 
+									greeting: str=LONGEST_GREETING) -> Optional[str]:
+	"""
+	Render a school's message body once, shortening long descriptions until 
+	it fits in MAX_SEGMENTS
+	"""
+	body = None
+	for desc_limit in (None, 80, 40, 20, 0):
+		msg = gen_school_body(school, date_str, meal_items, desc_limit)
+		if not msg:
+			return None
+		body = '\n'.join(msg)
+		template = MessageTemplate(greeting, body)
+		if not MAX_SEGMENTS or template.segments('x' * NAME_ALLOWANCE) <= MAX_SEGMENTS:
+			break
+	return body
+
+def get_school_items(school: str, 
+										sources: Dict[str, dict], 
+										date: datetime, 
+										meals: List[str], 
+										fetcher: MenuFetcher) -> Dict[str, tuple]:
+	meal_items = {}
+	for meal in meals:
+		if meal.upper() not in sources:
+			continue
+		try:			
+			with metrics.timer('gen_message', meal=meal):
+				items = get_meal_items(sources[meal.upper()], date, fetcher)
+		except Exception:
+			current_app.logger.exception(f'Failed to get {meal} menu for {school}')
+		else:
+			meal_items[meal] = (sources[meal.upper()], items)
+	return meal_items
+
+def gen_digest_body(school: str, 
+										sources: Dict[str, dict], 
+										dates: List[datetime], 
+										meals: List[str], 
+										fetcher: MenuFetcher,
+										greeting: str=LONGEST_GREETING) -> Optional[str]:
+	"""
+	Compact multi-day message with item names only, listing fewer items per 
+	meal, then one line per day with shortened names, until it fits in 
+	MAX_SEGMENTS
+	"""
+	days = [(date, get_school_items(school, sources, date, meals, fetcher)) for date in dates]
+	period = (f"{custom_strftime('%B {S}', dates[0])} - "
+						f"{custom_strftime('%B {S}, %Y', dates[-1])}")
+	body = None
+	for item_limit, name_limit, one_line in (
+		(None, None, False), (3, None, False), (2, None, False), (1, None, False), 
+		(1, 20, True), (1, 12, True),
+	):
+		msg = []
+		for date, meal_items in days:
+			day = []
+			for meal, (source, items) in meal_items.items():
+				meal_msg = format_meal(
+					{**source, 'long': False}, 
+					[{**item, 'name': shorten(item['name'], name_limit)} for item in items[:item_limit]],
+				)
+				if meal_msg:
+					more = len(items) - len(items[:item_limit])
+					day.append(f'{meal}: {meal_msg[0]}' + (f' (+{more} more)' if more and not one_line else ''))
+			if day and one_line:
+				msg.append(f"{custom_strftime('%a {S}', date)} - {'; '.join(day)}")
+			elif day:
+				msg += ['', custom_strftime('%A {S}', date)] + day
+		if not msg:
+			return None
+		if one_line:
+			msg = [''] + msg
+		body = '\n'.join([f'{school} meal options for {period}'] + msg + ['', 'Have a nice week!'])
+		if not MAX_SEGMENTS or MessageTemplate(greeting, body).segments('x' * NAME_ALLOWANCE) <= MAX_SEGMENTS:
+			break
+	return body
+
+def next_week(today: Optional[datetime]=None) -> tuple:
+	"""Monday and Friday of the coming school week"""
+	today = today or datetime.now()
+	monday = today + timedelta(days=7 - today.weekday())
+	return monday, monday + timedelta(days=4)
+
+def school_days(start: datetime, days: int) -> List[datetime]:
+	dates = []
+	date = start
+	while len(dates) < days:
+		if date.weekday() < 5:
+			dates.append(date)
+		date += timedelta(days=1)
+	return dates
+
+def prefetch_messages(days: int=PREFETCH_DAYS, 
+											start: Optional[datetime]=None) -> List[str]:
+	"""
+	Fetch, validate and store rendered school messages for the next school 
+	days so the send job only has to dispatch. Only complete messages from 
+	fresh menus are stored, the rest are rendered at send time. Returns the 
+	missing menus.
+	"""
+	start = start or datetime.now() + timedelta(days=1)
+	prune_rendered(datetime.now().strftime('%Y-%m-%d'))
+	dates = school_days(start, days)
+	meals = ['Breakfast', 'Lunch']
+	schools = active_schools()
+	fetcher = MenuFetcher()
+	fetcher.prefetch(
+		[meal for school in schools.values() for meal in school.values()], 
+		dates,
+	)
+	missing = []
+	for date in dates:
+		date_str = custom_strftime('%A, %B {S}, %Y', date)
+		for school, sources in schools.items():
+			if not get_schedule(school).in_session(date):
+				continue
+			meal_items = get_school_items(school, sources, date, meals, fetcher)
+			school_missing = [
+				f'{school} {meal} on {date:%Y-%m-%d}' for meal in meals 
+				if meal.upper() in sources and not meal_items.get(meal, (None, None))[1]
+			]
+			missing.extend(school_missing)
+			stale = any((source['id'], date.month, date.year) in fetcher.stale 
+									for source in sources.values())
+			body = render_school(school, date_str, meal_items)
+			if body is None or school_missing or stale:
+				# A stored partial message would be sent even after the menu is published
+				discard_rendered(school, date.strftime('%Y-%m-%d'))
+			else:
+				save_rendered(school, date.strftime('%Y-%m-%d'), body)
+	if missing:
+		current_app.logger.error(f'Menus missing: {", ".join(missing)}')
+	stale = fetcher.stale_menus(schools)
+	if stale:
+		current_app.logger.warning(f'Stale menus rendered: {", ".join(stale)}')
+	return missing
+
+def send_messages(date: Optional[datetime]=None, 
+									user_message: Optional[str]=None,
+									until: Optional[datetime]=None,
+									include: Optional[Iterable[str]]=None) -> DispatchSummary:
+	"""
+	Send tomorrow's (or date's) menu to daily subscribers, a digest of the 
+	school days from date to until to weekly subscribers when until is set, 
+	or user_message to everyone. include limits the run to those schools.
+	"""
 	if date is None:
 		date = datetime.now() + timedelta(days=1)
 	date_str = custom_strftime('%A, %B {S}, %Y', date)
 	meals = ['Breakfast', 'Lunch']
+	fetcher = MenuFetcher()
+	tag = 'menu'
+	delivery = 'daily'
+	digest_dates = None
+	run_start = metrics.snapshot()
+	rendered = {}
+	if user_message is not None:
+		delivery = None
+	elif until is not None:
+		tag = 'digest'
+		delivery = 'weekly'
+		digest_dates = [date + timedelta(days=i) for i in range((until - date).days + 1)
+										if (date + timedelta(days=i)).weekday() < 5]
+	# Only resolve schools that have subscribers
+	schools = active_schools(delivery)
+	if include is not None:
+		include = set(include)
+		schools = {school: sources for school, sources in schools.items() 
+								if school in include}
+	if user_message is None and digest_dates is None:
+		# Holidays and days outside the school year
+		schools = {school: sources for school, sources in schools.items() 
+								if get_schedule(school).in_session(date)}
+	if digest_dates is not None:
+		# Ranges crossing a month boundary fetch both months once
+		fetcher.prefetch(
+			[meal for sources in schools.values() for meal in sources.values()], 
+			digest_dates,
+		)
+	elif user_message is None:
+		# Messages stored by the prefetch job skip the menu APIs
+		rendered = load_rendered(date.strftime('%Y-%m-%d'))
+		fetcher.prefetch(
+			[meal for school, sources in schools.items() if school not in rendered 
+				for meal in sources.values()], 
+			[date],
+		)
+	elif isinstance(user_message, str):
+		if os.path.isfile(user_message):
+			with open(user_message) as f:
+				user_message = f.read()
+		tag = 'msg:' + hashlib.sha1(user_message.encode()).hexdigest()[:12]
 	
-	for school in MENU_ID.keys():
-		msg = []
-		if user_message is None:
-			for meal in meals:
-				try:			
-					meal_msg = gen_message(MENU_ID[school][meal.upper()], date=date)
-				except Exception as ex:
-					meal_msg = None
-					print('Something went wrong')
-					print(ex)
-				if meal_msg:
-					prefix = f'{meal} option'
-					prefix += 's are:' if len(meal_msg) > 1 else ' is:'
-					msg.append(prefix)
-					msg.extend(meal_msg)
-					msg.append('')
-			if msg:		
-				msg = [f'{school} meal options for {date_str}', ''] + msg + ['Have a nice day!']
-		elif isinstance(user_message, str):
-			if os.path.isfile(user_message):
-					with open(user_message) as f:
-							msg = f.read().splitlines()
-			else:
-					msg = user_message.splitlines()	
-		if msg:	
-			db = get_db()
-			users = db.execute(f"SELECT * FROM user WHERE school='{school}'").fetchall()
-			for person in users:
-				body = f"{greet()} {person['username']},\n" + '\n'.join(msg)
-				send_text(phone=person['phone'], body=body)
-	
\ No newline at end of file
+	outbox.enqueue(
+		gen_texts(schools, date, date_str, meals, fetcher, user_message, rendered, 
+							digest_dates, delivery), 
+		date=date.strftime('%Y-%m-%d'),
+		tag=tag,
+	)
+	start = time.time()
+	for school in schools:
+		window = get_schedule(school).window
+		if window:
+			outbox.stagger(date.strftime('%Y-%m-%d'), tag, school, window * 60, start)
+	summary = outbox.drain(date=date.strftime('%Y-%m-%d'), tag=tag, schools=list(schools))
+	stale = fetcher.stale_menus(schools)
+	if stale:
+		current_app.logger.warning(f'Stale menus sent: {", ".join(stale)}')
+	current_app.logger.info(f'Run metrics: {metrics.summary(run_start)}')
+	# Pushed now rather than on the next interval, the worker may exit first
+	metrics.save_app()
+	return summary
+
+def gen_texts(schools: Dict[str, Dict[str, dict]],
+							date: datetime, 
+							date_str: str, 
+							meals: List[str], 
+							fetcher: MenuFetcher, 
+							user_message: Optional[str]=None,
+							rendered: Optional[Dict[str, str]]=None,
+							digest_dates: Optional[List[datetime]]=None,
+							delivery: Optional[str]=None) -> Iterable[tuple]:
+	rendered = rendered or {}
+	user_body = None
+	if isinstance(user_message, str) and (lines := user_message.splitlines()):
+		user_body = '\n'.join(lines)
+	for school, sources in schools.items():
+		template = None
+		schedule = get_schedule(school)
+		# Recipients are greeted for the time at their school
+		greeting = greet(schedule.now().hour)
+		if user_message is not None:
+			if user_body is not None:
+				template = MessageTemplate(greeting, user_body)
+		elif digest_dates is not None:
+			dates = [date for date in digest_dates if schedule.in_session(date)]
+			body = dates and gen_digest_body(school, sources, dates, meals, fetcher, greeting)
+			if body:
+				template = MessageTemplate(greeting, body)
+		else:
+			body = rendered.get(school)
+			if body is None:
+				meal_items = get_school_items(school, sources, date, meals, fetcher)
+				body = render_school(school, date_str, meal_items, greeting)
+			if body is not None:
+				template = MessageTemplate(greeting, body)
+		if template is not None:	
+			for person in iter_subscribers(school, delivery):
+				body, segments = template.render(person['username'])
+				yield person['id'], school, person['phone'], body, segments
@@ -0,0 +1,222 @@
+import atexit
+from contextlib import contextmanager
+from flask import (
+  abort,
+  Blueprint, 
+  request,
+  Response,
+)
+import functools
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PREFIX = 'menu_notifier_'
+METRICS_TOKEN = os.getenv('MENU_NOTIFIER_METRICS_TOKEN')
+# Seconds between writes of each process's metrics to the shared table
+SAVE_INTERVAL = float(os.getenv('MENU_NOTIFIER_METRICS_INTERVAL', '15'))
+
+bp = Blueprint('metrics', __name__)
+
+class Metrics:
+	"""
+	Counters and timing histograms. Each process counts in memory and adds 
+	what it recorded to the metric table every SAVE_INTERVAL, /metrics 
+	reports the table so all workers and the scheduler are included.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.timings = {}
+		# Series added since the last save, (family, kind, series, labels) -> delta
+		self.unsaved: Dict[Tuple[str, str, str, str], float] = {}
+		self.app = None
+		self.thread = None
+
+	@staticmethod
+	def key(name: str, labels: dict) -> Tuple[str, tuple]:
+		return name, tuple(sorted(labels.items()))
+
+	def stage(self, family: str, kind: str, series: str, labels, value: float) -> None:
+		key = (family, kind, series, fmt(labels))
+		self.unsaved[key] = self.unsaved.get(key, 0) + value
+
+	def inc(self, name: str, value: float=1, **labels) -> None:
+		key = self.key(name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+			family = f'{PREFIX}{name}_total'
+			self.stage(family, 'counter', family, key[1], value)
+			self.start()
+
+	def observe(self, name: str, seconds: float, **labels) -> None:
+		key = self.key(name, labels)
+		family = f'{PREFIX}{name}_seconds'
+		with self.lock:
+			timing = self.timings.get(key)
+			if timing is None:
+				timing = self.timings[key] = [0, 0.0, [0] * len(BUCKETS)]
+			timing[0] += 1
+			timing[1] += seconds
+			for i, bound in enumerate(BUCKETS):
+				hit = seconds <= bound
+				if hit:
+					timing[2][i] += 1
+				# Empty buckets are saved too so every series has all of them
+				self.stage(family, 'histogram', f'{family}_bucket', key[1] + (('le', bound),), int(hit))
+			self.stage(family, 'histogram', f'{family}_bucket', key[1] + (('le', '+Inf'),), 1)
+			self.stage(family, 'histogram', f'{family}_sum', key[1], seconds)
+			self.stage(family, 'histogram', f'{family}_count', key[1], 1)
+			self.start()
+
+	def start(self) -> None:
+		if self.thread is None and self.app is not None:
+			self.thread = threading.Thread(target=self.run, name='metrics-writer', daemon=True)
+			self.thread.start()
+			atexit.register(self.save_app)
+
+	def run(self) -> None:
+		while True:
+			time.sleep(SAVE_INTERVAL)
+			self.save_app()
+
+	def save_app(self) -> None:
+		from .db import get_db
+		if not self.unsaved:
+			return
+		try:
+			with self.app.app_context():
+				self.save(get_db())
+		except Exception:
+			# Not logged as an error, that would raise an alert every interval
+			self.app.logger.warning('Failed to save metrics', exc_info=True)
+
+	def save(self, db) -> int:
+		"""
+		Add everything recorded since the last save to the metric table, kept 
+		for the next save if the write fails
+		"""
+		with self.lock:
+			unsaved, self.unsaved = self.unsaved, {}
+		if not unsaved:
+			return 0
+		try:
+			with db:
+				db.executemany(
+					'INSERT INTO metric (family, kind, series, labels, value) VALUES (?, ?, ?, ?, ?)'
+					' ON CONFLICT (series, labels) DO UPDATE SET value = value + excluded.value',
+					[(*key, value) for key, value in unsaved.items()],
+				)
+		except Exception:
+			with self.lock:
+				for key, value in unsaved.items():
+					self.unsaved[key] = self.unsaved.get(key, 0) + value
+			raise
+		return len(unsaved)
+
+	@contextmanager
+	def timer(self, name: str, **labels):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, **labels)
+
+	def timed(self, name: str, **labels):
+		def decorator(f):
+			@functools.wraps(f)
+			def wrapper(*args, **kwargs):
+				with self.timer(name, **labels):
+					return f(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def snapshot(self) -> Dict[str, Tuple[float, Optional[float]]]:
+		"""Count and total seconds (None for counters) per metric name"""
+		totals = {}
+		with self.lock:
+			for (name, _), value in self.counters.items():
+				count, _ = totals.get(name, (0, None))
+				totals[name] = (count + value, None)
+			for (name, _), (count, seconds, _) in self.timings.items():
+				prev_count, prev_seconds = totals.get(name, (0, 0.0))
+				totals[name] = (prev_count + count, (prev_seconds or 0.0) + seconds)
+		return totals
+
+	def summary(self, since: Dict[str, Tuple[float, Optional[float]]]) -> str:
+		"""One line of what was recorded after the since snapshot"""
+		parts = []
+		for name, (count, seconds) in sorted(self.snapshot().items()):
+			prev_count, prev_seconds = since.get(name, (0, None))
+			if count == prev_count:
+				continue
+			if seconds is None:
+				parts.append(f'{name}={count - prev_count:g}')
+			else:
+				parts.append(f'{name}={count - prev_count}/{seconds - (prev_seconds or 0.0):.2f}s')
+		return ', '.join(parts)
+
+	def render(self, db) -> str:
+		"""Exposition text for the totals saved by every process"""
+		lines = []
+		family = None
+		for row in db.execute(
+			'SELECT family, kind, series, labels, value FROM metric ORDER BY family, rowid'
+		):
+			if row['family'] != family:
+				family = row['family']
+				lines.append(f'# TYPE {family} {row["kind"]}')
+			lines.append(f'{row["series"]}{row["labels"]} {row["value"]:.15g}')
+		return '\n'.join(lines) + '\n'
+
+def fmt(labels) -> str:
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+metrics = Metrics()
+
+class RetryCounter:
+	"""Logger for @retry that counts each retry"""
+	def __init__(self, name: str, logger):
+		self.name = name
+		self.logger = logger
+
+	def warning(self, msg, *args, **kwargs):
+		metrics.inc(self.name)
+		self.logger.warning(msg, *args, **kwargs)
+
+@bp.route('/metrics')
+def metrics_endpoint():
+	if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+		abort(404)
+	from .db import get_db
+	db = get_db()
+	# This process's latest counts, the others catch up within SAVE_INTERVAL
+	metrics.save(db)
+	return Response(metrics.render(db), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+	app.register_blueprint(bp)
+	if metrics.app is None:
+		# The first app's database collects this process's metrics
+		metrics.app = app
+
+	@app.before_request
+	def start_timer():
+		request.start_time = time.perf_counter()
+
+	@app.after_request
+	def record_request(response):
+		start = getattr(request, 'start_time', None)
+		if start is not None and request.endpoint not in (None, 'static', 'metrics.metrics_endpoint'):
+			metrics.observe(
+				'http_request', 
+				time.perf_counter() - start,
+				endpoint=request.endpoint, 
+				status=response.status_code,
+			)
+		return response
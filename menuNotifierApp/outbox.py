@@ -0,0 +1,219 @@
+import click
+from datetime import datetime
+from flask import current_app
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+from .db import get_db
+from .metrics import metrics
+from .dispatch import dispatch, DispatchSummary, shared_bucket
+from .twilio import send_text
+
+BATCH_SIZE = int(os.getenv('MENU_NOTIFIER_OUTBOX_BATCH', '200'))
+MAX_ATTEMPTS = int(os.getenv('MENU_NOTIFIER_OUTBOX_ATTEMPTS', '3'))
+# Longest drain sleeps before checking for newly due staggered messages
+MAX_WAIT = float(os.getenv('MENU_NOTIFIER_OUTBOX_MAX_WAIT', '30'))
+
+def enqueue(messages: Iterable[Tuple[int, str, str, str, int]], 
+						date: str, 
+						tag: str='menu') -> int:
+	"""
+	Add (user_id, school, phone, body, segments) messages to the outbox, 
+	messages already queued for the same user, date, school and tag are 
+	ignored so a run can be repeated safely
+	"""
+	db = get_db()
+	count = 0
+	batch = []
+
+	def flush():
+		now = time.time()
+		with metrics.timer('db_query', query='outbox_enqueue'):
+			cur = db.executemany(
+				'INSERT OR IGNORE INTO outbox'
+				' (user_id, date, school, tag, phone, body, segments, created, updated)'
+				' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+				[(user_id, date, school, tag, phone, body, segments, now, now) 
+					for user_id, school, phone, body, segments in batch],
+			)
+			db.commit()
+		batch.clear()
+		return cur.rowcount
+
+	for message in messages:
+		batch.append(message)
+		if len(batch) >= BATCH_SIZE:
+			count += flush()
+	if batch:
+		count += flush()
+	return count
+
+def stagger(date: str, tag: str, school: str, window: float, start: float) -> int:
+	"""
+	Spread a school's pending messages evenly over window seconds from 
+	start, so large schools don't hit the messaging service all at once
+	"""
+	db = get_db()
+	ids = [row['id'] for row in db.execute(
+		"SELECT id FROM outbox WHERE date = ? AND tag = ? AND school = ?"
+		" AND status = 'pending' ORDER BY id",
+		(date, tag, school),
+	)]
+	if ids:
+		step = window / len(ids)
+		db.executemany(
+			'UPDATE outbox SET not_before = ? WHERE id = ?',
+			[(start + n * step, key) for n, key in enumerate(ids)],
+		)
+		db.commit()
+	return len(ids)
+
+def queued(retry_failed: bool=False, 
+					date: Optional[str]=None, 
+					tag: Optional[str]=None,
+					schools: Optional[List[str]]=None) -> Tuple[str, list]:
+	"""WHERE clause and parameters for messages a drain may still send"""
+	statuses = ('pending', 'failed') if retry_failed else ('pending',)
+	clause = f"status IN ({', '.join('?' * len(statuses))}) AND attempts < ?"
+	params = [*statuses, MAX_ATTEMPTS]
+	for column, value in (('date', date), ('tag', tag)):
+		if value is not None:
+			clause += f' AND {column} = ?'
+			params.append(value)
+	if schools is not None:
+		clause += f" AND school IN ({', '.join('?' * len(schools))})"
+		params.extend(schools)
+	return clause, params
+
+@metrics.timed('db_query', query='outbox_claim')
+def claim_batch(retry_failed: bool=False, 
+								date: Optional[str]=None, 
+								tag: Optional[str]=None,
+								schools: Optional[List[str]]=None):
+	"""
+	Mark a batch of due messages as sending in one statement, so concurrent 
+	drains never claim the same message
+	"""
+	db = get_db()
+	clause, params = queued(retry_failed, date, tag, schools)
+	now = time.time()
+	rows = db.execute(
+		"UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated = ?"
+		f" WHERE id IN (SELECT id FROM outbox WHERE {clause} AND not_before <= ?"
+		" ORDER BY id LIMIT ?) RETURNING id, phone, body, segments",
+		(now, *params, now, BATCH_SIZE),
+	).fetchall()
+	db.commit()
+	return rows
+
+def next_due(retry_failed: bool=False, 
+						date: Optional[str]=None, 
+						tag: Optional[str]=None,
+						schools: Optional[List[str]]=None) -> Optional[float]:
+	db = get_db()
+	clause, params = queued(retry_failed, date, tag, schools)
+	return db.execute(
+		f'SELECT MIN(not_before) FROM outbox WHERE {clause}', 
+		params,
+	).fetchone()[0]
+
+def expire_past(today: Optional[str]=None, 
+								keep: Optional[Tuple[str, str]]=None) -> int:
+	"""
+	Retire unsent messages for days that have passed, so a later run never
+	sends yesterday's menu. keep is a (date, tag) run being sent on purpose.
+	"""
+	db = get_db()
+	today = today or datetime.now().strftime('%Y-%m-%d')
+	keep = keep or ('', '')
+	cur = db.execute(
+		"UPDATE outbox SET status = 'expired', updated = ?"
+		" WHERE status IN ('pending', 'failed') AND date < ?"
+		" AND NOT (date = ? AND tag = ?)",
+		(time.time(), today, *keep),
+	)
+	db.commit()
+	return cur.rowcount
+
+def drain(retry_failed: bool=False, 
+					wait: bool=True, 
+					date: Optional[str]=None, 
+					tag: Optional[str]=None,
+					schools: Optional[List[str]]=None) -> DispatchSummary:
+	"""
+	Send queued messages in batches, optionally only a run's date, tag and 
+	schools, so concurrent per-school runs leave each other's messages alone. 
+	Each outcome is recorded as it completes so an interrupted run resumes 
+	with the messages that were not sent. With wait, staggered messages are 
+	sent as they fall due.
+	"""
+	db = get_db()
+	total = DispatchSummary()
+	bucket = shared_bucket()
+	expired = expire_past(keep=(date, tag) if date and tag else None)
+	if expired:
+		current_app.logger.warning(f'{expired} unsent messages for past days expired')
+	stale = db.execute(
+		"SELECT COUNT(*) FROM outbox WHERE status = 'sending'"
+	).fetchone()[0]
+	if stale:
+		current_app.logger.warning(
+			f'{stale} messages were interrupted mid-send and will not be resent, '
+			'use drain-outbox --requeue-stale to retry them'
+		)
+
+	def record(key, sid, error):
+		# On the draining thread, one short transaction per message
+		with metrics.timer('db_query', query='outbox_update'):
+			db.execute(
+				'UPDATE outbox SET status = ?, sid = ?, error = ?, updated = ? WHERE id = ?',
+				('failed' if error else 'sent', sid, error and str(error), time.time(), key),
+			)
+			db.commit()
+		if not error:
+			sent.append(key)
+
+	while True:
+		rows = claim_batch(retry_failed, date, tag, schools)
+		if not rows:
+			due = next_due(retry_failed, date, tag, schools) if wait else None
+			if due is None:
+				break
+			time.sleep(min(max(due - time.time(), 0), MAX_WAIT))
+			continue
+		sent = []
+		segments = {row['id']: row['segments'] for row in rows}
+		summary = dispatch(
+			((row['id'], row['phone'], row['body']) for row in rows),
+			send=send_text,
+			on_result=record,
+			bucket=bucket,
+		)
+		summary.segments = sum(segments[key] for key in sent)
+		total.merge(summary)
+	return total
+
+def requeue_stale() -> int:
+	db = get_db()
+	cur = db.execute(
+		"UPDATE outbox SET status = 'pending', updated = ? WHERE status = 'sending'",
+		(time.time(),),
+	)
+	db.commit()
+	return cur.rowcount
+
+@click.command('drain-outbox')
+@click.option('--retry-failed', is_flag=True, help='Resend failed messages')
+@click.option('--requeue-stale', 'requeue', is_flag=True, 
+							help='Resend messages interrupted mid-send, may duplicate')
+@click.option('--due-only', is_flag=True, 
+							help='Skip staggered messages that are not due yet')
+def drain_outbox_command(retry_failed, requeue, due_only):
+	"""Send queued messages."""
+	if requeue:
+		click.echo(f'Requeued {requeue_stale()} interrupted messages')
+	summary = drain(retry_failed=retry_failed, wait=not due_only)
+	click.echo(f'Messages sent: {summary}')
+
+def init_app(app):
+	app.cli.add_command(drain_outbox_command)
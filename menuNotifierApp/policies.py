@@ -1,14 +1,12 @@
-from flask import (
-  Blueprint, 
-  render_template, 
-)
+from flask import Blueprint
+from .httpcache import render_cached
 
 bp = Blueprint('policies', __name__, url_prefix='/policies')
 
 @bp.route('/privacy')
 def privacy():
-	return render_template('policies/privacy.html')
+	return render_cached('policies/privacy.html')
 
 @bp.route('/terms')
 def terms():
-	return render_template('policies/terms.html')
\ No newline at end of file
+	return render_cached('policies/terms.html')
\ No newline at end of file
@@ -0,0 +1,44 @@
+import click
+import re
+import subprocess
+import sys
+from typing import List
+
+# Same work as a gunicorn worker boot or a flask command before it runs
+STARTUP = f'from {__package__} import create_app; create_app()'
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def import_times(statement: str=STARTUP) -> List[tuple]:
+	"""
+	Run statement in a fresh interpreter with -X importtime and return
+	(module, self_us, cumulative_us, depth) for every import it made
+	"""
+	result = subprocess.run(
+		[sys.executable, '-X', 'importtime', '-c', statement],
+		capture_output=True,
+		text=True,
+	)
+	if result.returncode != 0:
+		raise click.ClickException(result.stderr.strip().splitlines()[-1])
+	times = []
+	for line in result.stderr.splitlines():
+		match = IMPORT_LINE.match(line)
+		if match:
+			own, cumulative, indent, module = match.groups()
+			times.append((module, int(own), int(cumulative), len(indent) // 2))
+	return times
+
+@click.command('profile-imports')
+@click.option('--top', default=20, show_default=True, help='Modules to list')
+@click.option('--statement', default=STARTUP, help='Code to profile')
+def profile_imports_command(top, statement):
+	"""Report where startup time goes, by import."""
+	times = import_times(statement)
+	total = sum(cumulative for _, _, cumulative, depth in times if depth == 0)
+	click.echo(f'{len(times)} modules imported in {total / 1000:.1f}ms')
+	click.echo(f'\n{"cumulative":>12} {"self":>10}  module')
+	for module, own, cumulative, depth in sorted(times, key=lambda t: -t[2])[:top]:
+		click.echo(f'{cumulative / 1000:>10.1f}ms {own / 1000:>8.1f}ms  {"  " * depth}{module}')
+
+def init_app(app):
+	app.cli.add_command(profile_imports_command)
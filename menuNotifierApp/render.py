@@ -0,0 +1,59 @@
+import math
+import os
+from typing import Optional, Tuple
+
+# Cap on segments per message, long descriptions are shortened to fit
+MAX_SEGMENTS = int(os.getenv('MENU_NOTIFIER_MAX_SEGMENTS', '3'))
+# Room left for the recipient's name when fitting a school's body
+NAME_ALLOWANCE = 15
+GSM7_BASIC = set(
+	'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+	'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+GSM7_EXTENDED = set('^{}\\[~]|€\f')
+
+def gsm_units(text: str) -> Optional[int]:
+	"""Septets needed to encode text in GSM-7, None if it needs UCS-2"""
+	units = 0
+	for c in text:
+		if c in GSM7_BASIC:
+			units += 1
+		elif c in GSM7_EXTENDED:
+			units += 2
+		else:
+			return None
+	return units
+
+def ucs2_units(text: str) -> int:
+	return len(text.encode('utf-16-le')) // 2
+
+def segments(units: int, gsm: bool) -> int:
+	single, multi = (160, 153) if gsm else (70, 67)
+	return 1 if units <= single else math.ceil(units / multi)
+
+def segment_count(text: str) -> int:
+	units = gsm_units(text)
+	if units is None:
+		return segments(ucs2_units(text), gsm=False)
+	return segments(units, gsm=True)
+
+class MessageTemplate:
+	"""
+	A school's message body with the greeting rendered once, recipients 
+	only add their name
+	"""
+	def __init__(self, greeting: str, body: str):
+		self.prefix = f'{greeting} '
+		self.suffix = ',\n' + body
+		text = self.prefix + self.suffix
+		self.gsm = gsm_units(text)
+		self.ucs2 = ucs2_units(text)
+
+	def segments(self, name: str='') -> int:
+		name_gsm = gsm_units(name) if self.gsm is not None else None
+		if name_gsm is None:
+			return segments(self.ucs2 + ucs2_units(name), gsm=False)
+		return segments(self.gsm + name_gsm, gsm=True)
+
+	def render(self, name: str) -> Tuple[str, int]:
+		return self.prefix + name + self.suffix, self.segments(name)
@@ -0,0 +1,216 @@
+import click
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import TYPE_CHECKING
+from .db import get_db
+from .schools import get_schedule, get_schedules
+
+if TYPE_CHECKING:
+	from flask_apscheduler import APScheduler
+
+CRONTAB = os.getenv('MENU_NOTIFIER_CRON', '0 19 * * 0-3,6')
+# Weekly digest for the coming Monday to Friday. APScheduler counts days 
+# from Monday, so name the day rather than using cron's 0 for Sunday.
+DIGEST_CRONTAB = os.getenv('MENU_NOTIFIER_DIGEST_CRON', '0 18 * * sun')
+# Hours ahead of the send window, so missing menus can be fixed in time
+PREFETCH_CRONTAB = os.getenv('MENU_NOTIFIER_PREFETCH_CRON', '0 13 * * *')
+SCHOOL_START = os.getenv('MENU_NOTIFIER_START', str(datetime.now().date()))
+# Lease on a job's lock, renewed while the job runs so a staggered send can 
+# outlast it. Another instance takes over this long after a holder dies.
+LOCK_TTL = int(os.getenv('MENU_NOTIFIER_LOCK_TTL', '600'))
+OWNER = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def acquire_lock(name: str, ttl: int=LOCK_TTL) -> bool:
+	db = get_db()
+	now = time.time()
+	db.execute(
+		'INSERT INTO job_lock (name, owner, expires) VALUES (?, ?, ?)'
+		' ON CONFLICT (name) DO UPDATE SET owner = excluded.owner,'
+		' expires = excluded.expires WHERE job_lock.expires < ?',
+		(name, OWNER, now + ttl, now),
+	)
+	db.commit()
+	lock = db.execute(
+		'SELECT owner FROM job_lock WHERE name = ?', 
+		(name,)
+	).fetchone()
+	return lock['owner'] == OWNER
+
+def renew_lock(name: str, ttl: int=LOCK_TTL) -> bool:
+	db = get_db()
+	cur = db.execute(
+		'UPDATE job_lock SET expires = ? WHERE name = ? AND owner = ?',
+		(time.time() + ttl, name, OWNER),
+	)
+	db.commit()
+	return cur.rowcount > 0
+
+def release_lock(name: str) -> None:
+	db = get_db()
+	db.execute('DELETE FROM job_lock WHERE name = ? AND owner = ?', (name, OWNER))
+	db.commit()
+
+@contextmanager
+def job_lock(name: str, ttl: int=LOCK_TTL):
+	"""
+	Hold name's lock for the block, renewing the lease every ttl / 3 from a 
+	background thread. Yields whether the lock was acquired.
+	"""
+	if not acquire_lock(name, ttl):
+		yield False
+		return
+	app = current_app._get_current_object()
+	done = threading.Event()
+
+	def renew():
+		while not done.wait(ttl / 3):
+			try:
+				with app.app_context():
+					if not renew_lock(name, ttl):
+						app.logger.error(f'Lost the {name} lock to another instance')
+						return
+			except Exception:
+				app.logger.warning(f'Failed to renew the {name} lock', exc_info=True)
+
+	thread = threading.Thread(target=renew, name=f'lock-{name}', daemon=True)
+	thread.start()
+	try:
+		yield True
+	finally:
+		done.set()
+		thread.join()
+		release_lock(name)
+
+def init_scheduler(app, scheduler=None) -> 'APScheduler':
+	# Only the scheduler worker needs APScheduler and the menu pipeline
+	from flask_apscheduler import APScheduler
+	from flask_apscheduler.utils import CronTrigger
+	from .menu_notifier import next_week, prefetch_messages, send_messages
+	scheduler = APScheduler(scheduler=scheduler)
+	scheduler.init_app(app)
+
+	@scheduler.task(
+		CronTrigger.from_crontab(CRONTAB),
+		id='send_sms',	
+		misfire_grace_time=4500,	
+	)
+	def sens_sms():
+		"""
+		Send notifications Weekdays at 7pm
+		"""
+		try:
+			today = datetime.now().date()
+			if today >= datetime.strptime(SCHOOL_START, '%Y-%m-%d').date():					
+				with app.app_context(), job_lock('send_sms') as locked:
+					if not locked:
+						app.logger.info('Messages are being sent by another instance')
+						return
+					app.logger.info('Sending messages')
+					# Schools with their own send time have their own job
+					summary = send_messages(include=[
+						school for school, schedule in get_schedules().items() 
+						if schedule.send_time is None
+					])
+					app.logger.info(str(summary))
+			else:
+				app.logger.info('School hasn''t started yet, skipping messages')
+		except:
+			app.logger.exception('Failed to send messages')
+
+	@scheduler.task(
+		CronTrigger.from_crontab(DIGEST_CRONTAB),
+		id='send_digest',	
+		misfire_grace_time=4500,	
+	)
+	def send_digest():
+		"""
+		Send the weekly digest Sunday evening
+		"""
+		try:
+			start, end = next_week()
+			if end.date() >= datetime.strptime(SCHOOL_START, '%Y-%m-%d').date():
+				with app.app_context(), job_lock('send_digest') as locked:
+					if not locked:
+						return
+					app.logger.info('Sending weekly digest')
+					summary = send_messages(date=start, until=end)
+					app.logger.info(str(summary))
+		except:
+			app.logger.exception('Failed to send weekly digest')
+
+	@scheduler.task(
+		CronTrigger.from_crontab(PREFETCH_CRONTAB),
+		id='prefetch_messages',	
+		misfire_grace_time=4500,	
+	)
+	def prefetch():
+		"""
+		Render the coming school days' messages ahead of the send window
+		"""
+		try:
+			with app.app_context(), job_lock('prefetch_messages') as locked:
+				if not locked:
+					return
+				app.logger.info('Prefetching menus')
+				prefetch_messages()
+		except:
+			app.logger.exception('Failed to prefetch menus')
+
+	def send_school(school: str):
+		"""
+		Send tomorrow's menu for one school at its own send time
+		"""
+		try:
+			with app.app_context():
+				schedule = get_schedule(school)
+				date = schedule.now() + timedelta(days=1)
+				if not schedule.is_school_day(date):
+					app.logger.info(f'No school at {school} on {date:%Y-%m-%d}, skipping messages')
+					return
+				with job_lock(f'send_sms:{school}') as locked:
+					if not locked:
+						app.logger.info(f'{school} messages are being sent by another instance')
+						return
+					app.logger.info(f'Sending messages for {school}')
+					summary = send_messages(date=date, include=[school])
+					app.logger.info(str(summary))
+		except:
+			app.logger.exception(f'Failed to send messages for {school}')
+
+	with app.app_context():
+		schedules = get_schedules()
+	for school, schedule in schedules.items():
+		if schedule.send_time is None:
+			continue
+		hour, minute = schedule.send_time.split(':')
+		scheduler.add_job(
+			f'send_sms:{school}',
+			send_school,
+			trigger=CronTrigger(hour=hour, minute=minute, timezone=schedule.timezone),
+			args=(school,),
+			misfire_grace_time=4500,
+		)
+		app.logger.info(f'Scheduling {school} at {schedule.send_time} '
+										f'{schedule.timezone or "server time"}')
+
+	app.logger.info(f'Starting scheduler with crontab "{CRONTAB}"')
+	return scheduler
+
+@click.command('run-scheduler')
+def run_scheduler_command():
+	"""Run the notification scheduler in the foreground."""
+	from apscheduler.schedulers.blocking import BlockingScheduler
+	scheduler = init_scheduler(current_app._get_current_object(), BlockingScheduler())
+	try:
+		scheduler.start()
+	except (KeyboardInterrupt, SystemExit):
+		pass
+
+def init_app(app):
+	app.cli.add_command(run_scheduler_command)
@@ -1,17 +1,143 @@
-DROP TABLE IF EXISTS user;
-DROP TABLE IF EXISTS retries;
+-- Applied by migrate on every deploy, every statement must be idempotent.
+-- Columns added to existing tables also go in db.COLUMNS.
 
-CREATE TABLE user (
+CREATE TABLE IF NOT EXISTS user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   username TEXT NOT NULL,
   phone TEXT UNIQUE NOT NULL,
-  school TEXT NOT NULL
+  school TEXT NOT NULL,
+  delivery TEXT NOT NULL DEFAULT 'daily' CHECK (delivery IN ('daily', 'weekly')),
+  -- Permanent delivery failures in a row, suspended numbers are skipped
+  failures INTEGER NOT NULL DEFAULT 0,
+  suspended REAL
 );
 
-CREATE TABLE retries (
+CREATE INDEX IF NOT EXISTS user_school ON user (school, delivery, id);
+
+CREATE TABLE IF NOT EXISTS retries (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   phone TEXT UNIQUE NOT NULL,
-  retry INTEGER NOT NULL
+  retry INTEGER NOT NULL,
+  expires REAL NOT NULL,
+  -- Latest verification send: pending, sent or failed, and when
+  code_status TEXT,
+  code_updated REAL
+);
+
+-- ON CONFLICT (phone) in users.increment_retries needs a unique index
+CREATE UNIQUE INDEX IF NOT EXISTS retries_phone ON retries (phone);
+
+CREATE INDEX IF NOT EXISTS retries_expires ON retries (expires);
+
+CREATE TABLE IF NOT EXISTS menu_cache (
+  key TEXT PRIMARY KEY,
+  month INTEGER NOT NULL,
+  year INTEGER NOT NULL,
+  value TEXT NOT NULL,
+  expires REAL NOT NULL,
+  accessed REAL NOT NULL
+);
+
+-- Product details by id, bounded separately from menu_cache
+CREATE TABLE IF NOT EXISTS product_cache (
+  id TEXT PRIMARY KEY,
+  value TEXT NOT NULL,
+  expires REAL NOT NULL,
+  accessed REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rendered_message (
+  school TEXT NOT NULL,
+  date TEXT NOT NULL,
+  body TEXT NOT NULL,
+  created REAL NOT NULL,
+  PRIMARY KEY (school, date)
+);
+
+CREATE TABLE IF NOT EXISTS school (
+  name TEXT PRIMARY KEY,
+  -- NULL settings fall back to server local time and the global crontab
+  timezone TEXT,
+  send_time TEXT,
+  start_date TEXT,
+  end_date TEXT,
+  send_window INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS holiday (
+  school TEXT NOT NULL REFERENCES school (name),
+  date TEXT NOT NULL,
+  PRIMARY KEY (school, date)
+);
+
+CREATE TABLE IF NOT EXISTS menu_source (
+  school TEXT NOT NULL REFERENCES school (name),
+  meal TEXT NOT NULL,
+  menu_id TEXT NOT NULL,
+  long INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (school, meal)
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER NOT NULL,
+  date TEXT NOT NULL,
+  school TEXT NOT NULL,
+  tag TEXT NOT NULL,
+  phone TEXT NOT NULL,
+  body TEXT NOT NULL,
+  segments INTEGER NOT NULL DEFAULT 1,
+  status TEXT NOT NULL DEFAULT 'pending',
+  sid TEXT,
+  error TEXT,
+  delivery TEXT,
+  error_code TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  not_before REAL NOT NULL DEFAULT 0,
+  created REAL NOT NULL,
+  updated REAL NOT NULL,
+  UNIQUE (user_id, date, school, tag)
+);
+
+CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id);
+
+CREATE INDEX IF NOT EXISTS outbox_sid ON outbox (sid);
+
+-- Delivery callbacks that arrived before their message's sid was saved
+CREATE TABLE IF NOT EXISTS status_pending (
+  sid TEXT PRIMARY KEY,
+  status TEXT NOT NULL,
+  error_code TEXT,
+  rank INTEGER NOT NULL DEFAULT 0,
+  received REAL NOT NULL
+);
+
+-- Metric totals from every process, family is the name /metrics reports
+-- series under and labels is the formatted label set
+CREATE TABLE IF NOT EXISTS metric (
+  family TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  series TEXT NOT NULL,
+  labels TEXT NOT NULL,
+  value REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (series, labels)
+);
+
+CREATE TABLE IF NOT EXISTS job_lock (
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires REAL NOT NULL
 );
 
+-- Seed the registry once, schools removed later stay removed
+INSERT INTO school (name)
+  SELECT name FROM (SELECT 'McAuliffe' AS name UNION ALL SELECT 'CUSD')
+  WHERE NOT EXISTS (SELECT 1 FROM school);
 
+INSERT INTO menu_source (school, meal, menu_id, long)
+  SELECT * FROM (VALUES
+    ('McAuliffe', 'BREAKFAST', '6136d437534a13f81e174a81', 0),
+    ('McAuliffe', 'LUNCH', '671fda48e96f1e3ea01554f7', 1),
+    ('CUSD', 'BREAKFAST', '6136d437534a13f81e174a81', 0),
+    ('CUSD', 'LUNCH', '55a02d4deabc88225e8b473f', 1))
+  WHERE NOT EXISTS (SELECT 1 FROM menu_source);
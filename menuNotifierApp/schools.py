@@ -0,0 +1,256 @@
+import click
+from dataclasses import dataclass, field
+from datetime import datetime
+import os
+import threading
+import time
+from typing import Dict, Optional, Set
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from .db import get_db, get_readonly_db
+
+# Seconds before other processes pick up registry changes
+REGISTRY_TTL = int(os.getenv('MENU_NOTIFIER_REGISTRY_TTL', '300'))
+# First day of school for schools without their own start_date
+SCHOOL_START = os.getenv('MENU_NOTIFIER_START')
+_registry = None
+_loaded = 0
+_lock = threading.Lock()
+
+def load_schools() -> Dict[str, Dict[str, dict]]:
+	db = get_db()
+	schools = {row['name']: {} for row in db.execute(
+		'SELECT name FROM school ORDER BY name'
+	)}
+	for row in db.execute('SELECT school, meal, menu_id, long FROM menu_source'):
+		if row['school'] in schools:
+			schools[row['school']][row['meal']] = {
+				'id': row['menu_id'],
+				'long': bool(row['long']),
+			}
+	return schools
+
+@dataclass
+class Schedule:
+	"""When a school's messages go out, unset fields keep the global defaults"""
+	timezone: Optional[str] = None
+	send_time: Optional[str] = None
+	start_date: Optional[str] = None
+	end_date: Optional[str] = None
+	# Minutes to spread the school's recipients over
+	window: int = 0
+	holidays: Set[str] = field(default_factory=set)
+
+	def now(self) -> datetime:
+		"""Naive wall clock time at the school"""
+		if self.timezone is None:
+			return datetime.now()
+		return datetime.now(ZoneInfo(self.timezone)).replace(tzinfo=None)
+
+	def in_session(self, date: datetime) -> bool:
+		day = date.strftime('%Y-%m-%d')
+		start_date = self.start_date or SCHOOL_START
+		return ((start_date is None or day >= start_date) and 
+						(self.end_date is None or day <= self.end_date) and 
+						day not in self.holidays)
+
+	def is_school_day(self, date: datetime) -> bool:
+		return date.weekday() < 5 and self.in_session(date)
+
+def load_schedules() -> Dict[str, Schedule]:
+	db = get_db()
+	schedules = {row['name']: Schedule(
+		timezone=row['timezone'],
+		send_time=row['send_time'],
+		start_date=row['start_date'],
+		end_date=row['end_date'],
+		window=row['send_window'],
+	) for row in db.execute(
+		'SELECT name, timezone, send_time, start_date, end_date, send_window FROM school'
+	)}
+	for row in db.execute('SELECT school, date FROM holiday'):
+		if row['school'] in schedules:
+			schedules[row['school']].holidays.add(row['date'])
+	return schedules
+
+def get_registry() -> tuple:
+	global _registry, _loaded
+	with _lock:
+		if _registry is None or time.monotonic() - _loaded > REGISTRY_TTL:
+			_registry = (load_schools(), load_schedules())
+			_loaded = time.monotonic()
+		return _registry
+
+def get_schools() -> Dict[str, Dict[str, dict]]:
+	"""
+	Registered schools mapped to their meal menu sources, 
+	cached in memory for REGISTRY_TTL seconds
+	"""
+	return get_registry()[0]
+
+def get_schedules() -> Dict[str, Schedule]:
+	return get_registry()[1]
+
+def get_schedule(school: str) -> Schedule:
+	return get_schedules().get(school) or Schedule()
+
+def refresh_schools() -> None:
+	global _registry
+	with _lock:
+		_registry = None
+
+def active_schools(delivery: Optional[str]=None) -> Dict[str, Dict[str, dict]]:
+	"""
+	Registered schools that have at least one subscriber, optionally with 
+	the given delivery frequency
+	"""
+	schools = get_schools()
+	db = get_readonly_db()
+	if delivery is None:
+		rows = db.execute('SELECT school FROM user GROUP BY school').fetchall()
+	else:
+		rows = db.execute(
+			'SELECT school FROM user WHERE delivery = ? GROUP BY school',
+			(delivery,)
+		).fetchall()
+	return {row['school']: schools[row['school']] for row in rows 
+					if row['school'] in schools}
+
+@click.command('add-school')
+@click.argument('name')
+@click.option('--breakfast', help='Breakfast menu type id')
+@click.option('--lunch', help='Lunch menu type id')
+@click.option('--long-breakfast', is_flag=True, help='Include item descriptions')
+@click.option('--short-lunch', is_flag=True, help='Omit item descriptions')
+def add_school_command(name, breakfast, lunch, long_breakfast, short_lunch):
+	"""Add or update a school and its menu sources."""
+	db = get_db()
+	db.execute('INSERT OR IGNORE INTO school (name) VALUES (?)', (name,))
+	for meal, menu_id, long in (('BREAKFAST', breakfast, long_breakfast), 
+															('LUNCH', lunch, not short_lunch)):
+		if menu_id:
+			db.execute(
+				'INSERT OR REPLACE INTO menu_source (school, meal, menu_id, long)'
+				' VALUES (?, ?, ?, ?)',
+				(name, meal, menu_id, int(long)),
+			)
+	db.commit()
+	refresh_schools()
+	click.echo(f'Saved school {name}.')
+
+@click.command('remove-school')
+@click.argument('name')
+def remove_school_command(name):
+	"""Remove a school and its menu sources."""
+	db = get_db()
+	db.execute('DELETE FROM menu_source WHERE school = ?', (name,))
+	db.execute('DELETE FROM holiday WHERE school = ?', (name,))
+	cur = db.execute('DELETE FROM school WHERE name = ?', (name,))
+	db.commit()
+	refresh_schools()
+	if cur.rowcount:
+		click.echo(f'Removed school {name}.')
+	else:
+		click.echo(f'No school named {name}.')
+
+def validate_timezone(ctx, param, value):
+	if value is not None:
+		try:
+			ZoneInfo(value)
+		except (ZoneInfoNotFoundError, ValueError):
+			raise click.BadParameter(f'Unknown timezone {value}')
+	return value
+
+def validate_time(ctx, param, value):
+	if value is not None:
+		try:
+			value = datetime.strptime(value, '%H:%M').strftime('%H:%M')
+		except ValueError:
+			raise click.BadParameter('Expected HH:MM')
+	return value
+
+@click.command('set-schedule')
+@click.argument('name')
+@click.option('--timezone', callback=validate_timezone, help='IANA name, e.g. America/Chicago')
+@click.option('--send-time', callback=validate_time, 
+							help='HH:MM school time to send the next day\'s menu')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), help='First school day')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), help='Last school day')
+@click.option('--window', type=click.IntRange(min=0), 
+							help='Minutes to spread recipients over')
+@click.option('--clear', is_flag=True, help='Reset to the global schedule first')
+def set_schedule_command(name, timezone, send_time, start, end, window, clear):
+	"""Set when a school's messages are sent."""
+	db = get_db()
+	if clear:
+		db.execute(
+			'UPDATE school SET timezone = NULL, send_time = NULL, start_date = NULL,'
+			' end_date = NULL, send_window = 0 WHERE name = ?',
+			(name,)
+		)
+	cur = db.execute(
+		'UPDATE school SET timezone = COALESCE(?, timezone),'
+		' send_time = COALESCE(?, send_time), start_date = COALESCE(?, start_date),'
+		' end_date = COALESCE(?, end_date), send_window = COALESCE(?, send_window)'
+		' WHERE name = ?',
+		(timezone, send_time, start and start.strftime('%Y-%m-%d'), 
+			end and end.strftime('%Y-%m-%d'), window, name),
+	)
+	db.commit()
+	refresh_schools()
+	if cur.rowcount:
+		click.echo(f'Saved schedule for {name}, restart the scheduler to apply it.')
+	else:
+		click.echo(f'No school named {name}.')
+
+@click.command('add-holiday')
+@click.argument('name')
+@click.argument('dates', nargs=-1, required=True, type=click.DateTime(['%Y-%m-%d']))
+def add_holiday_command(name, dates):
+	"""Skip a school's messages on the given days."""
+	db = get_db()
+	db.executemany(
+		'INSERT OR IGNORE INTO holiday (school, date) VALUES (?, ?)',
+		[(name, date.strftime('%Y-%m-%d')) for date in dates],
+	)
+	db.commit()
+	refresh_schools()
+	click.echo(f'Saved {len(dates)} holidays for {name}.')
+
+@click.command('remove-holiday')
+@click.argument('name')
+@click.argument('dates', nargs=-1, required=True, type=click.DateTime(['%Y-%m-%d']))
+def remove_holiday_command(name, dates):
+	"""Send a school's messages on previously skipped days."""
+	db = get_db()
+	db.executemany(
+		'DELETE FROM holiday WHERE school = ? AND date = ?',
+		[(name, date.strftime('%Y-%m-%d')) for date in dates],
+	)
+	db.commit()
+	refresh_schools()
+	click.echo(f'Removed holidays for {name}.')
+
+@click.command('list-schools')
+def list_schools_command():
+	"""List registered schools, their menu sources and schedules."""
+	schedules = get_schedules()
+	for name, meals in get_schools().items():
+		sources = ', '.join(f"{meal}={meal_src['id']}" for meal, meal_src in meals.items())
+		schedule = schedules.get(name) or Schedule()
+		times = ', '.join(f'{key}={val}' for key, val in (
+			('timezone', schedule.timezone), 
+			('send_time', schedule.send_time), 
+			('start', schedule.start_date),
+			('end', schedule.end_date),
+			('window', schedule.window or None),
+			('holidays', len(schedule.holidays) or None),
+		) if val is not None)
+		click.echo(f'{name}: {sources}' + (f' [{times}]' if times else ''))
+
+def init_app(app):
+	app.cli.add_command(add_school_command)
+	app.cli.add_command(remove_school_command)
+	app.cli.add_command(list_schools_command)
+	app.cli.add_command(set_schedule_command)
+	app.cli.add_command(add_holiday_command)
+	app.cli.add_command(remove_holiday_command)
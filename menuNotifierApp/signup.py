@@ -1,6 +1,7 @@
 from flask import (
   Blueprint, 
   flash, 
+  jsonify,
   Markup,
   redirect, 
   render_template, 
@@ -12,6 +13,7 @@ from flask import current_app as app
 from flask_wtf import FlaskForm
 import os
 import re
+import sqlite3
 from wtforms.validators import (
   DataRequired, 
   Regexp, 
@@ -25,7 +27,10 @@ from wtforms.fields import (
   TelField, 
   Label
 )
-from .db import get_db
+from .httpcache import render_cached
+from .schools import get_schools
+from . import tasks
+from . import users
 from .twilio import (
   send_email, 
   verify_send, 
@@ -44,7 +49,11 @@ class PhoneForm(FlaskForm):
 				      			'placeholder': 'Your phone number'}, 
 		  							validators=[DataRequired(), Regexp(PHONE_PAT, 
 										message='Incorrect phone format, should be (xxx) yyy-zzzz')])
-	school = SelectField('School', choices=['McAuliffe', 'CUSD'])
+	school = SelectField('School')
+	delivery = SelectField('Delivery', choices=[
+		('daily', 'Daily, the evening before'),
+		('weekly', 'Weekly, Sunday evening'),
+	])
 	terms = BooleanField(default=False, validators=[AnyOf([True], 
 												message='You must agree to the terms to sign up')])
 	submit = SubmitField()
@@ -55,27 +64,32 @@ class VerifyForm(FlaskForm):
 							       	message="Code should be 6 digits")])
 	submit = SubmitField('Verify')
 
-def phone_exists(phone):
-	db = get_db()
-	user = db.execute(
-		'SELECT * FROM user WHERE phone = ?', 
-		(phone,)
-	).fetchone()
-	return user is not None
+def send_code(phone):
+	"""
+	Send a verification code in the background, its state is kept in the 
+	database for users.code_status
+	"""
+	users.set_code_status(phone, 'pending')
+	flask_app = app._get_current_object()
 
-def get_retries(phone):
-	db = get_db()
-	retries = db.execute(
-		'SELECT * FROM retries WHERE phone = ?', 
-		(phone,)
-	).fetchone()
-	return retries['retry'] if retries else 0
+	def send_verification():
+		try:
+			verify_send(phone)
+		except Exception:
+			with flask_app.app_context():
+				users.set_code_status(phone, 'failed')
+			raise
+		with flask_app.app_context():
+			users.set_code_status(phone, 'sent')
+
+	tasks.submit(send_verification, retries=1)
 
 @bp.route('/', methods=('GET', 'POST'))
 def signup():
 	if SUMMER:
-		return render_template('summer.html')	
+		return render_cached('summer.html')
 	form = PhoneForm()
+	form.school.choices = list(get_schools())
 	form.terms.label = Label(form.terms.id, Markup(
 		'By signing up you agree to the '
 		f'<a href="{ url_for("policies.terms") }">Terms and Conditions</a> and '
@@ -85,6 +99,7 @@ def signup():
 		name = form.name.data
 		phone = form.phone.data
 		school = form.school.data
+		delivery = form.delivery.data
 		app.logger.info(f'User {name} trying to sign up with phone {phone}')
 		error = None
 
@@ -100,7 +115,7 @@ def signup():
 			error = 'Incorrect phone format, should be (xxx) yyy-zzzz'		
 		else:
 			phone = '+1' + ''.join(phone.groups())
-			if phone_exists(phone):
+			if users.lookup(phone)['registered']:
 				return render_template('signup/success.html')
 
 		if error is None:
@@ -108,6 +123,7 @@ def signup():
 			session['name'] = name
 			session['phone'] = phone
 			session['school'] = school
+			session['delivery'] = delivery
 			return redirect(url_for("signup.verify"))
 		else:
 			app.logger.info(f'User encountered error: {error}')
@@ -122,39 +138,26 @@ def verify():
 	name = session['name']
 	phone = session['phone']
 	school = session['school']
+	delivery = session.get('delivery', 'daily')
 	form = VerifyForm()
 	error = None
-	if phone_exists(phone):
+	state = users.lookup(phone)
+	if state['registered']:
 		return render_template('signup/success.html')
-	if (retries := get_retries(phone)) > 5:
+	if state['retry'] > 5:
 		error = 'There was an issue sending code'
 	if error is None:		
 		if request.method == 'GET':
+			app.logger.info(f'Sending verification code to {phone}')
+			send_code(phone)
 			try:
-				app.logger.info(f'Sending verification code to {phone}')
-				verify_send(phone)
-			except:
-				error = 'Could not send verification code'
-				app.logger.exception('Failed to send verification code')
-			else:
-				db = get_db()
-				# Increment retries
-				try:
-					if retries == 0:
-						db.execute(
-							'INSERT INTO retries (phone, retry) VALUES (?, 1)',
-							(phone,),
-						)
-					else:
-						db.execute(
-								'UPDATE retries SET retry = retry + 1 WHERE phone = ?',
-								(phone,),
-							)
-					db.commit()	
-					session['retries'] = 0
-				except db.IntegrityError:
-					app.logger.exception('Failed to update DB')	
-		if form.validate_on_submit():
+				users.increment_retries(phone)
+				session['retries'] = 0
+			except sqlite3.Error:
+				app.logger.exception('Failed to update DB')	
+		elif users.code_status(phone) == 'failed':
+			error = 'Could not send verification code'
+		if error is None and form.validate_on_submit():
 			session['retries'] = session.get('retries', 0) + 1
 			if session['retries'] > 5:
 				error = 'Too many attempts. Try again later'
@@ -168,24 +171,13 @@ def verify():
 					if check:
 						app.logger.info('User successfully verified, adding to DB')
 						try:
-							db = get_db()
-							db.execute(
-									'DELETE FROM retries WHERE phone = ?',
-									(phone,),
-								)
-							db.execute(
-								'INSERT INTO user (username, phone, school) VALUES (?, ?, ?)',
-								(name, phone, school),
+							users.add_user(name, phone, school, delivery)
+							tasks.submit(
+								send_email,
+								subject='New User Signed Up!', 
+								body=f'{name} registered with phone {phone}',
 							)
-							db.commit()		
-							try:
-								send_email(
-									subject='New User Signed Up!', 
-									body=f'{name} registered with phone {phone}',
-								)
-							except Exception:
-								app.logger.exception('Failed to send email')
-						except db.IntegrityError:
+						except sqlite3.IntegrityError:
 							error = 'Something went wrong, please try again'	
 							app.logger.exception('Failed to update DB')	
 						else:
@@ -198,4 +190,9 @@ def verify():
 		flash(error, 'error')
 
 	return render_template('signup/verify.html', form=form, phone=phone[-4:])
-	
\ No newline at end of file
+
+@bp.route('/verify/status')
+def verify_status():
+	if 'phone' not in session:
+		return jsonify(status='unknown')
+	return jsonify(status=users.code_status(session['phone']))
@@ -0,0 +1,192 @@
+import atexit
+import click
+from flask import (
+  abort,
+  Blueprint,
+  current_app,
+  request,
+)
+import os
+import threading
+import time
+from typing import Dict, Optional
+from .db import get_db
+from .metrics import metrics
+from .twilio import AUTH_TOKEN, STATUS_CALLBACK_URL
+
+# Callbacks are written once this many are buffered, or every FLUSH_INTERVAL
+FLUSH_SIZE = int(os.getenv('MENU_NOTIFIER_STATUS_BATCH', '500'))
+FLUSH_INTERVAL = float(os.getenv('MENU_NOTIFIER_STATUS_INTERVAL', '5'))
+# Permanent failures in a row before a number stops getting messages
+SUSPEND_AFTER = int(os.getenv('MENU_NOTIFIER_SUSPEND_AFTER', '3'))
+# Twilio error codes that won't go away by retrying tomorrow: invalid,
+# unsubscribed, unreachable, unknown and landline numbers
+PERMANENT_ERRORS = {
+	code.strip() for code in
+	os.getenv('MENU_NOTIFIER_PERMANENT_ERRORS', '21211,21610,21614,30003,30005,30006').split(',')
+}
+FINAL_STATUSES = ('delivered', 'undelivered', 'failed')
+# Seconds a callback for an unknown sid is kept waiting for its message
+PENDING_TTL = int(os.getenv('MENU_NOTIFIER_STATUS_PENDING_TTL', str(24*3600)))
+# Later statuses win when callbacks for a message arrive out of order
+STATUS_RANK = {'queued': 0, 'sending': 1, 'sent': 2, 'delivered': 3, 'undelivered': 3, 'failed': 3}
+
+bp = Blueprint('status', __name__, url_prefix='/twilio')
+
+class StatusBuffer:
+	"""
+	Collects delivery callbacks in memory, keeping the latest status per
+	message, and writes them to the database in one transaction per batch
+	from a background thread
+	"""
+	def __init__(self, app, size: int=FLUSH_SIZE, interval: float=FLUSH_INTERVAL):
+		self.app = app
+		self.size = size
+		self.interval = interval
+		self.pending: Dict[str, tuple] = {}
+		self.lock = threading.Lock()
+		self.wake = threading.Event()
+		self.thread = None
+
+	def add(self, sid: str, status: str, error_code: Optional[str]) -> None:
+		with self.lock:
+			current = self.pending.get(sid)
+			if current is None or STATUS_RANK.get(status, 0) >= STATUS_RANK.get(current[0], 0):
+				self.pending[sid] = (status, error_code)
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, name='status-writer', daemon=True)
+				self.thread.start()
+				# Only processes that received callbacks write at exit
+				atexit.register(self.flush)
+			if len(self.pending) >= self.size:
+				self.wake.set()
+
+	def run(self) -> None:
+		while True:
+			self.wake.wait(self.interval)
+			self.wake.clear()
+			try:
+				self.flush()
+			except Exception:
+				self.app.logger.exception('Failed to save delivery statuses')
+
+	def flush(self) -> int:
+		with self.lock:
+			batch = self.pending
+			self.pending = {}
+			if not batch and self.thread is None:
+				return 0
+		with self.app.app_context(), metrics.timer('db_query', query='status_update'):
+			save_statuses(batch)
+		return len(batch)
+
+def apply_status(db, sid: str, status: str, error_code: Optional[str], now: float) -> bool:
+	"""
+	Record a message's delivery status and count permanent failures against 
+	its recipient, suspending numbers after SUSPEND_AFTER in a row. False 
+	when no sent message has the sid yet.
+	"""
+	cur = db.execute(
+		'UPDATE outbox SET delivery = ?, error_code = ?, updated = ?'
+		' WHERE sid = ? AND COALESCE(delivery, \'\') NOT IN (?, ?, ?)',
+		(status, error_code, now, sid, *FINAL_STATUSES),
+	)
+	if not cur.rowcount:
+		# Either a repeated final callback or one that beat the sid to the outbox
+		return db.execute('SELECT 1 FROM outbox WHERE sid = ?', (sid,)).fetchone() is not None
+	if status == 'delivered':
+		db.execute(
+			'UPDATE user SET failures = 0'
+			' WHERE id = (SELECT user_id FROM outbox WHERE sid = ?) AND failures > 0',
+			(sid,),
+		)
+	elif status in FINAL_STATUSES and error_code in PERMANENT_ERRORS:
+		db.execute(
+			'UPDATE user SET failures = failures + 1, suspended = CASE'
+			' WHEN failures + 1 >= ? THEN COALESCE(suspended, ?) ELSE suspended END'
+			' WHERE id = (SELECT user_id FROM outbox WHERE sid = ?)',
+			(SUSPEND_AFTER, now, sid),
+		)
+		metrics.inc('delivery_permanent_failures', code=error_code)
+	return True
+
+def save_statuses(statuses: Dict[str, tuple]) -> None:
+	"""
+	Apply buffered callbacks in one transaction. Callbacks for sids not yet 
+	in the outbox are parked in status_pending and applied once the sid is 
+	recorded, parked callbacks older than PENDING_TTL are dropped.
+	"""
+	db = get_db()
+	now = time.time()
+	with db:
+		parked = {row['sid']: (row['status'], row['error_code']) for row in db.execute(
+			'SELECT p.sid, p.status, p.error_code FROM status_pending p'
+			' JOIN outbox o ON o.sid = p.sid'
+		)}
+		for sid, (status, error_code) in parked.items():
+			apply_status(db, sid, status, error_code, now)
+		if parked:
+			db.executemany('DELETE FROM status_pending WHERE sid = ?', [(sid,) for sid in parked])
+		for sid, (status, error_code) in statuses.items():
+			if not apply_status(db, sid, status, error_code, now):
+				db.execute(
+					'INSERT INTO status_pending (sid, status, error_code, rank, received)'
+					' VALUES (?, ?, ?, ?, ?) ON CONFLICT (sid) DO UPDATE SET'
+					' status = excluded.status, error_code = excluded.error_code,'
+					' rank = excluded.rank, received = excluded.received'
+					' WHERE excluded.rank >= status_pending.rank',
+					(sid, status, error_code, STATUS_RANK.get(status, 0), now),
+				)
+		cur = db.execute('DELETE FROM status_pending WHERE received < ?', (now - PENDING_TTL,))
+		if cur.rowcount:
+			metrics.inc('delivery_status_unmatched', value=cur.rowcount)
+
+def valid_signature() -> bool:
+	from twilio.request_validator import RequestValidator
+	# Behind a proxy request.url may not be the URL Twilio signed
+	url = STATUS_CALLBACK_URL or request.url
+	signature = request.headers.get('X-Twilio-Signature', '')
+	return RequestValidator(AUTH_TOKEN).validate(url, request.form, signature)
+
+@bp.route('/status', methods=('POST',))
+def delivery_status():
+	if not valid_signature():
+		abort(403)
+	sid = request.form.get('MessageSid')
+	status = request.form.get('MessageStatus')
+	if sid and status:
+		current_app.extensions['status_buffer'].add(sid, status, request.form.get('ErrorCode'))
+		metrics.inc('delivery_status', status=status)
+	return '', 204
+
+@click.command('reinstate-number')
+@click.argument('phone')
+def reinstate_number_command(phone):
+	"""Resume messages to a suspended number."""
+	db = get_db()
+	cur = db.execute(
+		'UPDATE user SET failures = 0, suspended = NULL WHERE phone = ?',
+		(phone,)
+	)
+	db.commit()
+	if cur.rowcount:
+		click.echo(f'Reinstated {phone}.')
+	else:
+		click.echo(f'No subscriber with phone {phone}.')
+
+@click.command('list-suspended')
+def list_suspended_command():
+	"""List numbers suspended after repeated delivery failures."""
+	for row in get_db().execute(
+		'SELECT phone, school, failures, suspended FROM user'
+		' WHERE suspended IS NOT NULL ORDER BY suspended'
+	):
+		click.echo(f"{row['phone']} ({row['school']}): {row['failures']} failures, "
+							 f"suspended {time.strftime('%Y-%m-%d', time.localtime(row['suspended']))}")
+
+def init_app(app):
+	buffer = StatusBuffer(app)
+	app.extensions['status_buffer'] = buffer
+	app.register_blueprint(bp)
+	app.cli.add_command(reinstate_number_command)
+	app.cli.add_command(list_suspended_command)
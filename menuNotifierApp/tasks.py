@@ -0,0 +1,50 @@
+import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import current_app, has_app_context
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+WORKERS = int(os.getenv('MENU_NOTIFIER_TASK_WORKERS', '4'))
+RETRIES = int(os.getenv('MENU_NOTIFIER_TASK_RETRIES', '3'))
+RETRY_DELAY = 2
+logger = logging.getLogger(__name__)
+_executor = None
+_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+	global _executor
+	with _lock:
+		if _executor is None:
+			_executor = ThreadPoolExecutor(
+				max_workers=WORKERS, 
+				thread_name_prefix='menu-notifier-task',
+			)
+			# Let queued emails go out before the worker exits
+			atexit.register(_executor.shutdown, wait=True)
+	return _executor
+
+def submit(fn: Callable, 
+					*args, 
+					retries: int=RETRIES, 
+					delay: float=RETRY_DELAY, 
+					**kwargs) -> Future:
+	"""
+	Run fn off the request thread, retrying failures with exponential 
+	back-off. The final failure is logged and set on the returned future.
+	"""
+	log = current_app.logger if has_app_context() else logger
+
+	def run():
+		for attempt in range(retries):
+			try:
+				return fn(*args, **kwargs)
+			except Exception:
+				if attempt == retries - 1:
+					log.exception(f'Background task {fn.__name__} failed')
+					raise
+				time.sleep(delay * 2 ** attempt)
+
+	return get_executor().submit(run)
@@ -1,13 +1,7 @@
-from http_logging.handler import AsyncHttpHandler
-from http_logging.transport import AsyncHttpTransport
+import logging
 import os
-from mailersend import (
-	EmailBuilder, 
-	EmailContact,
-	MailerSendClient, 
-)
-from twilio.rest import Client
-from typing import Optional, List
+import threading
+from typing import Callable, Optional
 
 APP_NAME = 'Menu Notifier'
 ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
@@ -16,9 +10,32 @@ SERVICE_ID = os.getenv('TWILIO_SERVICE_ID')
 VERIFY_SID = os.getenv('TWILIO_VERIFY_SID')		
 MAILERSEND_FROM_EMAIL = os.getenv('MAILERSEND_FROM_EMAIL')
 MAILERSEND_TO_EMAIL = os.getenv('MAILERSEND_TO_EMAIL')
-client = Client(ACCOUNT_SID, AUTH_TOKEN)
+# Public URL of the status.delivery_status route, Twilio posts delivery updates there
+STATUS_CALLBACK_URL = os.getenv('MENU_NOTIFIER_STATUS_CALLBACK')
+# Clients are built on first use so imports, CLI commands and tests that 
+# never reach Twilio or MailerSend don't pay for (or need) them
+_client = None
+_mailer = None
+_client_lock = threading.Lock()
+
+def get_client():
+	global _client
+	with _client_lock:
+		if _client is None:
+			from twilio.rest import Client
+			_client = Client(ACCOUNT_SID, AUTH_TOKEN)
+	return _client
+
+def get_mailer():
+	global _mailer
+	with _client_lock:
+		if _mailer is None:
+			from mailersend import MailerSendClient
+			_mailer = MailerSendClient()
+	return _mailer
 
 def send_email(subject: str, body: str, reply_to: Optional[tuple[str]]=None) -> None:
+	from mailersend import EmailBuilder, EmailContact
 	email = (EmailBuilder()
 		.from_email(MAILERSEND_FROM_EMAIL, APP_NAME)
 		.to(MAILERSEND_TO_EMAIL)
@@ -29,101 +46,58 @@ def send_email(subject: str, body: str, reply_to: Optional[tuple[str]]=None) ->
 	if reply_to is not None:
 		email.reply_to = EmailContact(email=reply_to[0], name=reply_to[1])
 	
-	ms = MailerSendClient()
-	ms.emails.send(email)
+	get_mailer().emails.send(email)
 
-def send_text(phone: str, body: str) -> None:
-	client.messages.create(  
+def send_text(phone: str, body: str) -> str:
+	message = get_client().messages.create(  
 		messaging_service_sid=SERVICE_ID, 
 		body=body,      
 		to=phone,
+		**({'status_callback': STATUS_CALLBACK_URL} if STATUS_CALLBACK_URL else {}),
 	) 
+	return message.sid
 
 def verify_send(phone: str) -> None:
-	client.verify \
+	get_client().verify \
 				.v2 \
 				.services(VERIFY_SID) \
 				.verifications \
 				.create(to=phone, channel='sms')
 
 def verify_check(phone: str, code: str) -> bool:
-	verification_check = client.verify \
+	verification_check = get_client().verify \
 															.v2 \
 															.services(VERIFY_SID) \
 															.verification_checks \
 															.create(to=phone, code=code)
 	return verification_check.status == 'approved'
 
-# Based on tutorial from 
-# https://www.twilio.com/blog/python-error-alerting-twilio-sendgrid
-class TwilioHttpTransport(AsyncHttpTransport):
-	def __init__(
-			self,
-			logger_name: str,
-			twilio_account_sid: Optional[str] = None,
-			twilio_auth_token: Optional[str] = None,
-			twilio_sender_number: Optional[str] = None,
-			alert_phone: Optional[str] = None,
-			alert_email: bool=False,
-			*args,
-			**kwargs,
-	) -> None:
-		self.logger_name = logger_name
-		self.alert_context = f'[{logger_name}] Alert from logger'
-
-		self.twilio_account_sid = twilio_account_sid
-		self.twilio_auth_token = twilio_auth_token
-		self.twilio_sender_number = twilio_sender_number
-
-		self.alert_phone = alert_phone
-		self.alert_email = alert_email
-		super().__init__(*args, **kwargs)
-
-	def send(self, events: List[bytes], **kwargs) -> None:
-		batches = list(self._HttpTransport__batches(events))
-
-		if self.alert_phone:
-			self.send_sms_alert(batches=batches)
-
-		if self.alert_email:
-			self.send_email_alert(batches=batches)
-
-	def send_sms_alert(self, batches: List[dict]) -> None:
-		twilio_client = Client(
-			username=self.twilio_account_sid,
-			password=self.twilio_auth_token,
-		)
-
-		sms_logs = ', '.join([
-			f"{log['level']['name']}: {log['message']}"
-			for batch in batches
-			for log in batch
-		])
-
-		twilio_client.messages.create(
-			body=f'[{self.alert_context}] {sms_logs}',
-			from_=self.twilio_sender_number,
-			to=self.alert_phone,
-		)
-
-	def send_email_alert(self, batches: List[dict]) -> None:
-		msg = '<hr>'.join([
-			self.build_log_html(log)
-			for batch in batches
-			for log in batch
-		])
-
-		send_email(subject=self.alert_context, body=msg)
-
-	def build_log_html(self, log):
-		return '<br>'.join([
-			f'<b>{key}:</b> {val}'
-			for key, val in log.items()
-		])
-	
-transport_class = TwilioHttpTransport(
-	logger_name=APP_NAME,
-	alert_email=True,
-)
-
-twilio_handler = AsyncHttpHandler(transport_class=transport_class)
\ No newline at end of file
+class LazyHandler(logging.Handler):
+	"""
+	Stands in for the handler built by factory, which is only created (and
+	its imports paid for) once a record passes this handler's level
+	"""
+	def __init__(self, factory: Callable[[], logging.Handler], level=logging.NOTSET):
+		super().__init__(level)
+		self.factory = factory
+		self.handler = None
+
+	def emit(self, record: logging.LogRecord) -> None:
+		if self.handler is None:
+			self.handler = self.factory()
+		self.handler.handle(record)
+
+	def flush(self) -> None:
+		if self.handler is not None:
+			self.handler.flush()
+
+	def close(self) -> None:
+		if self.handler is not None:
+			self.handler.close()
+		super().close()
+
+def alert_handler() -> logging.Handler:
+	from .alerts import alert_handler
+	return alert_handler()
+
+twilio_handler = LazyHandler(alert_handler)
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import time
+from .db import get_db
+
+# Seconds before a phone's verification attempts are forgotten
+RETRY_TTL = int(os.getenv('MENU_NOTIFIER_RETRY_TTL', str(24*3600)))
+PURGE_INTERVAL = 3600
+# Seconds a verification send's state is reported, after that it is unknown
+CODE_STATUS_TTL = 600
+_last_purge = 0
+
+def lookup(phone: str) -> sqlite3.Row:
+	"""Whether phone is registered and its current retry count"""
+	db = get_db()
+	return db.execute(
+		'SELECT EXISTS (SELECT 1 FROM user'
+		' WHERE phone = :phone AND suspended IS NULL) AS registered,'
+		' COALESCE((SELECT retry FROM retries'
+		' WHERE phone = :phone AND expires > :now), 0) AS retry',
+		{'phone': phone, 'now': time.time()},
+	).fetchone()
+
+def increment_retries(phone: str) -> int:
+	"""Atomically bump the retry counter, restarting it once expired"""
+	db = get_db()
+	now = time.time()
+	retry = db.execute(
+		'INSERT INTO retries (phone, retry, expires) VALUES (?, 1, ?)'
+		' ON CONFLICT (phone) DO UPDATE SET'
+		' retry = CASE WHEN retries.expires > ? THEN retries.retry + 1 ELSE 1 END,'
+		' expires = excluded.expires'
+		' RETURNING retry',
+		(phone, now + RETRY_TTL, now),
+	).fetchone()['retry']
+	db.commit()
+	purge_retries()
+	return retry
+
+def set_code_status(phone: str, status: str) -> None:
+	"""
+	Record a verification send as pending, sent or failed on the phone's 
+	retries row, so any worker can report it
+	"""
+	db = get_db()
+	now = time.time()
+	db.execute(
+		'INSERT INTO retries (phone, retry, expires, code_status, code_updated)'
+		' VALUES (?, 0, ?, ?, ?) ON CONFLICT (phone) DO UPDATE SET'
+		' code_status = excluded.code_status, code_updated = excluded.code_updated',
+		(phone, now + RETRY_TTL, status, now),
+	)
+	db.commit()
+
+def code_status(phone: str) -> str:
+	"""State of the latest verification send to phone, unknown once stale"""
+	row = get_db().execute(
+		'SELECT code_status FROM retries WHERE phone = ? AND code_updated > ?',
+		(phone, time.time() - CODE_STATUS_TTL),
+	).fetchone()
+	if row is None or row['code_status'] is None:
+		return 'unknown'
+	return row['code_status']
+
+def purge_retries(force: bool=False) -> int:
+	"""Delete expired retry rows, at most once per PURGE_INTERVAL"""
+	global _last_purge
+	now = time.time()
+	if not force and now - _last_purge < PURGE_INTERVAL:
+		return 0
+	_last_purge = now
+	db = get_db()
+	cur = db.execute('DELETE FROM retries WHERE expires <= ?', (now,))
+	db.commit()
+	return cur.rowcount
+
+def add_user(name: str, phone: str, school: str, delivery: str='daily') -> None:
+	db = get_db()
+	with db:
+		db.execute('DELETE FROM retries WHERE phone = ?', (phone,))
+		# A suspended number that verifies again is reachable, resubscribe it
+		added = db.execute(
+			'INSERT INTO user (username, phone, school, delivery) VALUES (?, ?, ?, ?)'
+			' ON CONFLICT (phone) DO UPDATE SET username = excluded.username,'
+			' school = excluded.school, delivery = excluded.delivery,'
+			' failures = 0, suspended = NULL WHERE user.suspended IS NOT NULL'
+			' RETURNING id',
+			(name, phone, school, delivery),
+		).fetchone()
+		if added is None:
+			raise sqlite3.IntegrityError('UNIQUE constraint failed: user.phone')
@@ -0,0 +1,53 @@
+import os
+
+# Settings read at import time
+os.environ.setdefault('TWILIO_ACCOUNT_SID', 'AC' + '0' * 32)
+os.environ.setdefault('TWILIO_AUTH_TOKEN', 'test')
+os.environ['MENU_NOTIFIER_SEND_RATE'] = '0'
+
+import pytest
+from menuNotifierApp import create_app, outbox
+from menuNotifierApp.db import get_db, migrate
+
+@pytest.fixture
+def app(tmp_path):
+	app = create_app({
+		'TESTING': True,
+		'DATABASE': str(tmp_path / 'test.sqlite'),
+	})
+	with app.app_context():
+		migrate()
+		yield app
+
+@pytest.fixture
+def db(app):
+	return get_db()
+
+class SendStub:
+	"""Stands in for send_text, recording messages and failing chosen phones"""
+	def __init__(self):
+		self.sent = []
+		self.fail = set()
+
+	def __call__(self, phone, body):
+		if phone in self.fail:
+			raise RuntimeError(f'Send to {phone} failed')
+		self.sent.append((phone, body))
+		return f'SM{len(self.sent):032d}'
+
+@pytest.fixture
+def send(monkeypatch):
+	stub = SendStub()
+	monkeypatch.setattr(outbox, 'send_text', stub)
+	return stub
+
+@pytest.fixture
+def add_user(db):
+	def add(phone, school='Elm', name='Sam'):
+		user_id = db.execute(
+			'INSERT INTO user (username, phone, school) VALUES (?, ?, ?) RETURNING id',
+			(name, phone, school),
+		).fetchone()['id']
+		db.commit()
+		return user_id
+	return add
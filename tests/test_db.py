@@ -0,0 +1,62 @@
+import pytest
+import sqlite3
+import threading
+from menuNotifierApp import db as db_module
+from menuNotifierApp.db import get_db, get_readonly_db, migrate, pooled_connection
+
+def test_connection_reused_across_app_contexts(app):
+	with app.app_context():
+		first = get_db()
+	with app.app_context():
+		assert get_db() is first
+
+def test_connection_per_thread(app):
+	database = app.config['DATABASE']
+	main = pooled_connection(database)
+	others = []
+
+	def run():
+		others.append(pooled_connection(database))
+		others.append(pooled_connection(database))
+
+	thread = threading.Thread(target=run)
+	thread.start()
+	thread.join()
+	assert others[0] is others[1]
+	assert others[0] is not main
+
+def test_connection_tuning(db):
+	assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+	assert db.execute('PRAGMA busy_timeout').fetchone()[0] == db_module.BUSY_TIMEOUT
+	assert db.row_factory is sqlite3.Row
+
+def test_readonly_connection_rejects_writes(app, db):
+	readonly = get_readonly_db()
+	assert readonly is not db
+	assert readonly.execute('SELECT COUNT(*) FROM user').fetchone()[0] == 0
+	with pytest.raises(sqlite3.OperationalError, match='readonly'):
+		readonly.execute("INSERT INTO holiday (school, date) VALUES ('Elm', '2026-12-25')")
+
+def test_migrate_is_idempotent(db):
+	assert migrate() == []
+	assert migrate() == []
+
+def test_migrate_adds_missing_columns(app, tmp_path):
+	database = str(tmp_path / 'old.sqlite')
+	old = sqlite3.connect(database)
+	old.executescript(
+		'CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+		' username TEXT NOT NULL, phone TEXT UNIQUE NOT NULL, school TEXT NOT NULL);'
+		"INSERT INTO user (username, phone, school) VALUES ('Sam', '+15550001', 'Elm');"
+		'CREATE TABLE retries (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+		' phone TEXT NOT NULL, retry INTEGER NOT NULL);'
+	)
+	old.close()
+	app.config['DATABASE'] = database
+	with app.app_context():
+		added = migrate()
+		assert 'user.delivery' in added
+		assert 'retries.expires' in added
+		row = get_db().execute('SELECT delivery, failures, suspended FROM user').fetchone()
+		assert tuple(row) == ('daily', 0, None)
+		assert migrate() == []
@@ -0,0 +1,105 @@
+import threading
+import time
+from menuNotifierApp import dispatch as dispatch_module
+from menuNotifierApp.dispatch import dispatch, DispatchSummary, shared_bucket, TokenBucket
+
+def test_bucket_starts_full():
+	bucket = TokenBucket(rate=1, capacity=3)
+	assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+def test_bucket_refills_at_rate():
+	bucket = TokenBucket(rate=100, capacity=1)
+	assert bucket.try_acquire()
+	assert not bucket.try_acquire()
+	time.sleep(0.03)
+	assert bucket.try_acquire()
+
+def test_bucket_acquire_waits():
+	bucket = TokenBucket(rate=50, capacity=1)
+	start = time.monotonic()
+	for _ in range(3):
+		bucket.acquire()
+	assert time.monotonic() - start >= 0.03
+
+def test_dispatch_sends_everything():
+	sent = []
+	summary = dispatch(
+		((n, f'+1555000{n:04d}', f'body {n}') for n in range(50)),
+		send=lambda phone, body: sent.append(phone) or phone,
+		concurrency=4,
+		rate=0,
+	)
+	assert summary.sent == 50
+	assert summary.failed == 0
+	assert sorted(sent) == sorted(f'+1555000{n:04d}' for n in range(50))
+	assert len(summary.latencies) == 50
+
+def test_dispatch_collects_failures():
+	def send(phone, body):
+		if phone.endswith('3'):
+			raise RuntimeError('unreachable')
+		return 'SM'
+
+	summary = dispatch(((n, f'+1{n}', 'hi') for n in range(10)), send=send, rate=0)
+	assert (summary.sent, summary.failed) == (9, 1)
+	assert summary.errors == [(3, 'unreachable')]
+
+def test_dispatch_reports_each_result_on_calling_thread():
+	results = {}
+	threads = set()
+
+	def on_result(key, result, error):
+		threads.add(threading.current_thread())
+		results[key] = (result, error is not None)
+
+	dispatch(
+		((n, str(n), 'hi') for n in range(6)),
+		send=lambda phone, body: f'SM{phone}',
+		on_result=on_result,
+		rate=0,
+	)
+	assert results == {n: (f'SM{n}', False) for n in range(6)}
+	assert threads == {threading.current_thread()}
+
+def test_dispatch_bounds_concurrency():
+	active = []
+	peak = []
+	lock = threading.Lock()
+
+	def send(phone, body):
+		with lock:
+			active.append(phone)
+			peak.append(len(active))
+		time.sleep(0.01)
+		with lock:
+			active.remove(phone)
+
+	dispatch(((n, str(n), 'hi') for n in range(20)), send=send, concurrency=3, rate=0)
+	assert max(peak) <= 3
+
+def test_dispatch_respects_shared_bucket():
+	bucket = TokenBucket(rate=100, capacity=1)
+	start = time.monotonic()
+	dispatch(((n, str(n), 'hi') for n in range(3)), send=lambda phone, body: None, bucket=bucket)
+	dispatch(((n, str(n), 'hi') for n in range(3)), send=lambda phone, body: None, bucket=bucket)
+	# One token up front, the other five wait 10ms each
+	assert time.monotonic() - start >= 0.04
+
+def test_shared_bucket_is_one_per_process(monkeypatch):
+	monkeypatch.setattr(dispatch_module, 'RATE', 5)
+	monkeypatch.setattr(dispatch_module, '_bucket', None)
+	bucket = shared_bucket()
+	assert bucket.rate == 5
+	assert shared_bucket() is bucket
+
+def test_no_shared_bucket_without_rate(monkeypatch):
+	monkeypatch.setattr(dispatch_module, 'RATE', 0)
+	monkeypatch.setattr(dispatch_module, '_bucket', None)
+	assert shared_bucket() is None
+
+def test_summary_merge():
+	total = DispatchSummary()
+	total.merge(DispatchSummary(sent=2, failed=1, segments=4, latencies=[0.1, 0.2]))
+	total.merge(DispatchSummary(sent=1, latencies=[0.3]))
+	assert (total.sent, total.failed, total.segments) == (3, 1, 4)
+	assert total.p50 == 0.2
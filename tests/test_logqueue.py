@@ -0,0 +1,8 @@
+from menuNotifierApp import create_app
+from menuNotifierApp.logqueue import BoundedQueueHandler
+
+def test_handlers_are_added_once(app, tmp_path):
+	create_app({'TESTING': True, 'DATABASE': str(tmp_path / 'other.sqlite')})
+	handlers = app.logger.handlers
+	assert len(handlers) == 1
+	assert isinstance(handlers[0], BoundedQueueHandler)
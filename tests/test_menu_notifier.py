@@ -0,0 +1,123 @@
+from datetime import datetime
+import time
+import pytest
+import requests
+import retry.api
+from menuNotifierApp import menu_notifier
+from menuNotifierApp.cache import cache_set
+from menuNotifierApp.menu_notifier import (
+	CircuitBreaker, CircuitOpen, get_meal_items, http_get, MenuFetcher
+)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+	"""Retry backoff delays, recorded instead of slept"""
+	delays = []
+	monkeypatch.setattr(retry.api.time, 'sleep', delays.append)
+	return delays
+
+def test_failed_menu_is_not_refetched(monkeypatch, sleeps):
+	calls = []
+
+	def get_menu_id(meal_id, month, year):
+		calls.append(meal_id)
+		raise ValueError('No menu data retrieved')
+
+	monkeypatch.setattr(menu_notifier, 'get_menu_id', get_menu_id)
+	fetcher = MenuFetcher()
+	meal = {'id': 'lunch', 'long': False}
+	date = datetime(2026, 10, 16)
+	with pytest.raises(ValueError):
+		get_meal_items(meal, date, fetcher)
+	assert (len(calls), sleeps) == (3, [2, 4])
+	# Another school on the same menu fails without upstream calls or backoff
+	with pytest.raises(ValueError, match='No menu data'):
+		get_meal_items(meal, date, fetcher)
+	assert (len(calls), sleeps) == (3, [2, 4])
+
+def test_prewarm_does_not_report_stale_menus(app, monkeypatch, sleeps):
+	def get_menu_id(meal_id, month, year):
+		raise ValueError('No menu data retrieved')
+
+	monkeypatch.setattr(menu_notifier, 'get_menu_id', get_menu_id)
+	runner = app.test_cli_runner()
+	runner.invoke(args=['add-school', 'Elm', '--lunch', 'L1'])
+	# Expired entries a regular run would fall back to
+	cache_set('menu_id:L1:2026-10', 'M1', ttl=-1, month=10, year=2026)
+	cache_set('menu_items:M1', {'16': [{'id': 'P1'}]}, ttl=-1, month=10, year=2026)
+	result = runner.invoke(args=['prewarm-menus', '--month', '10', '--year', '2026'])
+	assert 'Failed to fetch L1 for 10/2026' in result.output
+	assert 'Cached' not in result.output
+	assert 16 in MenuFetcher().fetch('L1', 10, 2026)
+
+class SessionStub:
+	"""Stands in for the upstream session, answering with status or raising it"""
+	def __init__(self, *responses):
+		self.responses = list(responses)
+		self.calls = 0
+
+	def get(self, url, params, timeout):
+		self.calls += 1
+		response = self.responses.pop(0)
+		if isinstance(response, Exception):
+			raise response
+		r = requests.Response()
+		r.status_code = response
+		r.url = url
+		return r
+
+@pytest.fixture
+def session(monkeypatch):
+	monkeypatch.setattr(menu_notifier, '_breakers', {})
+	def session(*responses):
+		stub = SessionStub(*responses)
+		monkeypatch.setattr(menu_notifier, '_session', stub)
+		return stub
+	return session
+
+def test_breaker_opens_after_failures(session):
+	menu_notifier._breakers['menus.test'] = CircuitBreaker(failures=2)
+	stub = session(requests.ConnectionError('refused'), 503)
+	with pytest.raises(requests.ConnectionError):
+		http_get('https://menus.test/api', {})
+	with pytest.raises(requests.HTTPError):
+		http_get('https://menus.test/api', {})
+	with pytest.raises(CircuitOpen):
+		http_get('https://menus.test/api', {})
+	assert stub.calls == 2
+
+def test_breaker_lets_one_probe_through():
+	breaker = CircuitBreaker(failures=1, cooldown=0.02)
+	breaker.record(False)
+	assert not breaker.allow()
+	time.sleep(0.03)
+	assert breaker.allow()
+	# Only the probe, others wait for its result
+	assert not breaker.allow()
+	breaker.record(False)
+	assert not breaker.allow()
+	time.sleep(0.03)
+	assert breaker.allow()
+	breaker.record(True)
+	assert breaker.allow() and breaker.allow()
+
+def test_not_found_counts_as_healthy(session):
+	menu_notifier._breakers['menus.test'] = CircuitBreaker(failures=1)
+	stub = session(404, 200)
+	with pytest.raises(requests.HTTPError):
+		http_get('https://menus.test/api', {})
+	assert http_get('https://menus.test/api', {}).status_code == 200
+	assert stub.calls == 2
+
+def test_stale_menu_is_served_when_upstream_fails(app, monkeypatch, sleeps):
+	def get_menu_id(meal_id, month, year):
+		raise ValueError('No menu data retrieved')
+
+	monkeypatch.setattr(menu_notifier, 'get_menu_id', get_menu_id)
+	cache_set('menu_id:L1:2026-10', 'M1', ttl=-1, month=10, year=2026)
+	cache_set('menu_items:M1', {'16': [{'id': 'P1'}]}, ttl=-1, month=10, year=2026)
+	fetcher = MenuFetcher()
+	assert fetcher.fetch('L1', 10, 2026) == {16: [{'id': 'P1'}]}
+	assert fetcher.stale == {('L1', 10, 2026)}
+	schools = {'Elm': {'LUNCH': {'id': 'L1'}}, 'Oak': {'LUNCH': {'id': 'L2'}}}
+	assert fetcher.stale_menus(schools) == ['Elm Lunch']
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+import time
+import pytest
+from menuNotifierApp import dispatch as dispatch_module, outbox
+from menuNotifierApp.dispatch import DispatchSummary
+
+TODAY = datetime.now().strftime('%Y-%m-%d')
+YESTERDAY = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+@pytest.fixture
+def queue(add_user):
+	def queue(phones, date=TODAY, tag='menu', school='Elm', segments=1):
+		return outbox.enqueue(
+			[(add_user(phone, school), school, phone, f'Menu for {phone}', segments)
+				for phone in phones],
+			date=date,
+			tag=tag,
+		)
+	return queue
+
+def statuses(db):
+	return {row['phone']: row['status'] for row in db.execute('SELECT phone, status FROM outbox')}
+
+def test_enqueue_ignores_repeats(db, queue):
+	assert queue(['+15550001', '+15550002']) == 2
+	user_id = db.execute("SELECT id FROM user WHERE phone = '+15550001'").fetchone()['id']
+	assert outbox.enqueue([(user_id, 'Elm', '+15550001', 'again', 1)], date=TODAY) == 0
+	assert db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0] == 2
+
+def test_drain_sends_and_records_each_message(db, queue, send):
+	queue(['+15550001', '+15550002', '+15550003'], segments=2)
+	summary = outbox.drain()
+	assert (summary.sent, summary.failed, summary.segments) == (3, 0, 6)
+	assert sorted(phone for phone, _ in send.sent) == ['+15550001', '+15550002', '+15550003']
+	rows = db.execute('SELECT status, sid, attempts FROM outbox').fetchall()
+	assert all(row['status'] == 'sent' and row['sid'] and row['attempts'] == 1 for row in rows)
+
+def test_failed_messages_are_kept_for_retry(db, queue, send):
+	queue(['+15550001', '+15550002'])
+	send.fail.add('+15550002')
+	summary = outbox.drain()
+	assert (summary.sent, summary.failed) == (1, 1)
+	row = db.execute("SELECT status, error FROM outbox WHERE phone = '+15550002'").fetchone()
+	assert row['status'] == 'failed'
+	assert 'failed' in row['error']
+	# Not resent without retry_failed
+	assert outbox.drain().sent == 0
+	send.fail.clear()
+	assert outbox.drain(retry_failed=True).sent == 1
+	assert statuses(db) == {'+15550001': 'sent', '+15550002': 'sent'}
+	assert [phone for phone, _ in send.sent].count('+15550001') == 1
+
+def test_retries_stop_at_max_attempts(db, queue, send):
+	queue(['+15550001'])
+	send.fail.add('+15550001')
+	for _ in range(outbox.MAX_ATTEMPTS + 2):
+		outbox.drain(retry_failed=True)
+	attempts = db.execute('SELECT attempts FROM outbox').fetchone()['attempts']
+	assert attempts == outbox.MAX_ATTEMPTS
+
+def test_resume_after_interrupted_run(db, queue, send):
+	queue(['+15550001', '+15550002', '+15550003'])
+	# A run that died after claiming: one sent, one mid-send, one never claimed
+	db.execute("UPDATE outbox SET status = 'sent', sid = 'SM1' WHERE phone = '+15550001'")
+	db.execute("UPDATE outbox SET status = 'sending', attempts = 1 WHERE phone = '+15550002'")
+	db.commit()
+	summary = outbox.drain()
+	assert summary.sent == 1
+	assert send.sent == [('+15550003', 'Menu for +15550003')]
+	# Mid-send messages may have gone out, only resent when asked
+	assert outbox.requeue_stale() == 1
+	assert outbox.drain().sent == 1
+	assert set(statuses(db).values()) == {'sent'}
+
+def test_claims_do_not_overlap(queue, monkeypatch):
+	queue([f'+1555000{n}' for n in range(6)])
+	monkeypatch.setattr(outbox, 'BATCH_SIZE', 4)
+	first = {row['id'] for row in outbox.claim_batch()}
+	second = {row['id'] for row in outbox.claim_batch()}
+	assert len(first) == 4
+	assert len(second) == 2
+	assert not first & second
+	assert outbox.claim_batch() == []
+
+def test_drain_is_scoped_to_its_run(db, queue, send):
+	queue(['+15550001'], school='Elm')
+	queue(['+15550002'], school='Oak')
+	queue(['+15550003'], school='Elm', tag='digest')
+	summary = outbox.drain(date=TODAY, tag='menu', schools=['Elm'])
+	assert summary.sent == 1
+	assert statuses(db) == {'+15550001': 'sent', '+15550002': 'pending', '+15550003': 'pending'}
+
+def test_past_days_expire(db, queue, send):
+	queue(['+15550001'], date=YESTERDAY)
+	queue(['+15550002'])
+	outbox.drain()
+	assert statuses(db) == {'+15550001': 'expired', '+15550002': 'sent'}
+
+def test_explicit_past_run_is_kept(db, queue, send):
+	queue(['+15550001'], date=YESTERDAY)
+	assert outbox.drain(date=YESTERDAY, tag='menu').sent == 1
+
+def test_staggered_messages_wait_until_due(db, queue, send):
+	queue(['+15550001', '+15550002'])
+	assert outbox.stagger(TODAY, 'menu', 'Elm', window=3600, start=time.time()) == 2
+	summary = outbox.drain(wait=False)
+	assert summary.sent == 1
+	assert statuses(db) == {'+15550001': 'sent', '+15550002': 'pending'}
+
+def test_drains_share_one_rate_limit(queue, send, monkeypatch):
+	monkeypatch.setattr(dispatch_module, 'RATE', 1000)
+	monkeypatch.setattr(dispatch_module, '_bucket', None)
+	buckets = []
+
+	def dispatch(messages, **kwargs):
+		buckets.append(kwargs['bucket'])
+		return DispatchSummary()
+
+	monkeypatch.setattr(outbox, 'dispatch', dispatch)
+	queue(['+15550001'], school='Elm')
+	queue(['+15550002'], school='Oak')
+	outbox.drain(date=TODAY, tag='menu', schools=['Elm'])
+	outbox.drain(date=TODAY, tag='menu', schools=['Oak'])
+	assert len(buckets) == 2
+	assert buckets[0] is not None
+	assert buckets[0] is buckets[1]
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+import pytest
+from menuNotifierApp import menu_notifier
+from menuNotifierApp.menu_notifier import gen_digest_body, MenuFetcher, render_school
+from menuNotifierApp.render import gsm_units, MessageTemplate, NAME_ALLOWANCE, segment_count
+
+def test_extended_characters_take_two_septets():
+	assert gsm_units('a^€') == 5
+	assert gsm_units('snow ☃') is None
+
+@pytest.mark.parametrize('text, count', [
+	('a' * 160, 1),
+	('a' * 161, 2),
+	('a' * 306, 2),
+	('a' * 307, 3),
+	# Extended characters count double
+	('^' * 80, 1),
+	('^' * 80 + 'a', 2),
+	# One character outside GSM-7 switches the whole message to UCS-2
+	('ś' * 70, 1),
+	('ś' * 71, 2),
+	('a' * 133 + 'ś', 2),
+	('a' * 134 + 'ś', 3),
+])
+def test_segment_count(text, count):
+	assert segment_count(text) == count
+
+def test_name_can_switch_template_encoding():
+	template = MessageTemplate('Hi', 'a' * 100)
+	assert template.segments('Sam') == 1
+	assert template.render('Śam') == (f'Hi Śam,\n{"a" * 100}', 2)
+
+def segments(body):
+	return MessageTemplate(menu_notifier.LONGEST_GREETING, body).segments('x' * NAME_ALLOWANCE)
+
+def long_items(count, length=200):
+	return [
+		{'id': f'P{n}', 'name': f'Item {n}', 'long_description': f'{n} ' + 'd' * length}
+		for n in range(count)
+	]
+
+def test_render_school_shortens_descriptions(monkeypatch):
+	monkeypatch.setattr(menu_notifier, 'MAX_SEGMENTS', 3)
+	meal_items = {'Lunch': ({'id': 'L1', 'long': True}, long_items(3))}
+	body = render_school('Elm', 'October 16th', meal_items)
+	assert segments(body) <= 3
+	assert 'Item 2: 2 ddd' in body
+	assert '...' in body
+	monkeypatch.setattr(menu_notifier, 'MAX_SEGMENTS', 0)
+	assert 'd' * 200 in render_school('Elm', 'October 16th', meal_items)
+
+def test_render_school_drops_descriptions_last(monkeypatch):
+	monkeypatch.setattr(menu_notifier, 'MAX_SEGMENTS', 1)
+	meal_items = {'Lunch': ({'id': 'L1', 'long': True}, long_items(3))}
+	body = render_school('Elm', 'October 16th', meal_items)
+	assert 'Item 0\nOR\nItem 1' in body
+
+def digest(monkeypatch, meals, count):
+	"""A week's digest with count items per meal, every day the same"""
+	items = [{'id': f'P{n}', 'name': f'Grilled cheese sandwich {n}'} for n in range(count)]
+	sources = {meal.upper(): {'id': meal, 'long': False} for meal in meals}
+	monkeypatch.setattr(
+		menu_notifier, 'get_school_items', 
+		lambda school, sources, date, meals, fetcher: {
+			meal: (sources[meal.upper()], items) for meal in meals
+		},
+	)
+	dates = [datetime(2026, 10, 19) + timedelta(days=n) for n in range(5)]
+	return gen_digest_body('Elm', sources, dates, meals, MenuFetcher())
+
+def test_digest_lists_fewer_items_to_fit(monkeypatch):
+	monkeypatch.setattr(menu_notifier, 'MAX_SEGMENTS', 3)
+	body = digest(monkeypatch, ['Lunch'], 4)
+	assert segments(body) <= 3
+	assert '\nMonday 19th\nLunch: Grilled cheese sandwich 0 (+3 more)\n' in body
+	monkeypatch.setattr(menu_notifier, 'MAX_SEGMENTS', 0)
+	assert 'Grilled cheese sandwich 3' in digest(monkeypatch, ['Lunch'], 4)
+
+def test_digest_falls_back_to_one_line_per_day(monkeypatch):
+	monkeypatch.setattr(menu_notifier, 'MAX_SEGMENTS', 3)
+	body = digest(monkeypatch, ['Breakfast', 'Lunch'], 3)
+	assert segments(body) <= 3
+	assert '\nMon 19th - Breakfast: Grilled chee...; Lunch: Grilled chee...\n' in body
+	assert 'more)' not in body
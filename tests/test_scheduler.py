@@ -0,0 +1,14 @@
+from datetime import datetime
+from apscheduler.triggers.cron import CronTrigger
+import pytz
+from menuNotifierApp.menu_notifier import next_week
+from menuNotifierApp.scheduler import DIGEST_CRONTAB
+
+def test_digest_fires_sunday_for_the_coming_week():
+	tz = pytz.timezone('America/New_York')
+	trigger = CronTrigger.from_crontab(DIGEST_CRONTAB, timezone=tz)
+	# Friday
+	fire = trigger.get_next_fire_time(None, tz.localize(datetime(2026, 10, 16, 12)))
+	assert fire.replace(tzinfo=None) == datetime(2026, 10, 18, 18)
+	monday, friday = next_week(fire.replace(tzinfo=None))
+	assert (monday.date(), friday.date()) == (datetime(2026, 10, 19).date(), datetime(2026, 10, 23).date())
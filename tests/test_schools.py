@@ -0,0 +1,22 @@
+from datetime import datetime
+from menuNotifierApp import schools
+from menuNotifierApp.schools import Schedule
+
+def test_in_session_uses_own_dates():
+	schedule = Schedule(start_date='2026-09-01', end_date='2027-06-15', holidays={'2026-11-26'})
+	assert not schedule.in_session(datetime(2026, 8, 31))
+	assert schedule.in_session(datetime(2026, 9, 1))
+	assert not schedule.in_session(datetime(2026, 11, 26))
+	assert not schedule.in_session(datetime(2027, 6, 16))
+
+def test_unset_start_date_falls_back_to_global_start(monkeypatch):
+	monkeypatch.setattr(schools, 'SCHOOL_START', '2026-09-08')
+	assert not Schedule(send_time='18:00').in_session(datetime(2026, 9, 7))
+	assert Schedule(send_time='18:00').in_session(datetime(2026, 9, 8))
+	# A school's own start date wins
+	assert Schedule(start_date='2026-09-01').in_session(datetime(2026, 9, 2))
+
+def test_weekends_are_not_school_days():
+	schedule = Schedule()
+	assert schedule.is_school_day(datetime(2026, 10, 16))
+	assert not schedule.is_school_day(datetime(2026, 10, 17))
@@ -0,0 +1,131 @@
+import time
+import pytest
+from menuNotifierApp import status
+from menuNotifierApp.db import iter_subscribers
+from menuNotifierApp.status import save_statuses, StatusBuffer
+from menuNotifierApp.users import lookup
+
+@pytest.fixture
+def message(db, add_user):
+	"""Add a sent message to phone, subscribing it if needed, returning its sid"""
+	def message(phone='+15550001', sid='SM1'):
+		user = db.execute('SELECT id FROM user WHERE phone = ?', (phone,)).fetchone()
+		user_id = user['id'] if user else add_user(phone)
+		now = time.time()
+		db.execute(
+			'INSERT INTO outbox (user_id, date, school, tag, phone, body, status, sid, created, updated)'
+			" VALUES (?, '2026-10-16', 'Elm', ?, ?, 'Menu', 'sent', ?, ?, ?)",
+			(user_id, sid, phone, sid, now, now),
+		)
+		db.commit()
+		return sid
+	return message
+
+def delivery(db, sid):
+	row = db.execute('SELECT delivery, error_code FROM outbox WHERE sid = ?', (sid,)).fetchone()
+	return tuple(row)
+
+def user(db, phone='+15550001'):
+	return db.execute('SELECT failures, suspended FROM user WHERE phone = ?', (phone,)).fetchone()
+
+def test_status_progresses(db, message):
+	sid = message()
+	save_statuses({sid: ('sent', None)})
+	assert delivery(db, sid) == ('sent', None)
+	save_statuses({sid: ('delivered', None)})
+	assert delivery(db, sid) == ('delivered', None)
+
+def test_final_status_is_kept(db, message):
+	sid = message()
+	save_statuses({sid: ('undelivered', '30003')})
+	# A late or repeated callback doesn't undo the final status
+	save_statuses({sid: ('sent', None)})
+	save_statuses({sid: ('delivered', None)})
+	assert delivery(db, sid) == ('undelivered', '30003')
+
+def test_buffer_keeps_latest_status(app):
+	buffer = StatusBuffer(app, size=100, interval=3600)
+	# Flushed by the test, not the writer thread
+	buffer.thread = object()
+	buffer.add('SM1', 'delivered', None)
+	buffer.add('SM1', 'sent', None)
+	buffer.add('SM2', 'queued', None)
+	buffer.add('SM2', 'failed', '30005')
+	assert buffer.pending == {'SM1': ('delivered', None), 'SM2': ('failed', '30005')}
+
+def test_buffer_flush_writes_batch(app, db, message):
+	sid = message()
+	buffer = StatusBuffer(app, size=100, interval=3600)
+	buffer.thread = object()
+	buffer.add(sid, 'delivered', None)
+	assert buffer.flush() == 1
+	assert buffer.pending == {}
+	assert delivery(db, sid) == ('delivered', None)
+
+def test_permanent_failures_suspend(db, message, monkeypatch):
+	monkeypatch.setattr(status, 'SUSPEND_AFTER', 2)
+	save_statuses({message(sid='SM1'): ('undelivered', '30003')})
+	assert tuple(user(db)) == (1, None)
+	assert lookup('+15550001')['registered']
+	save_statuses({message(sid='SM2'): ('failed', '21610')})
+	assert user(db)['failures'] == 2
+	assert user(db)['suspended'] is not None
+	assert not lookup('+15550001')['registered']
+	assert list(iter_subscribers('Elm')) == []
+
+def test_transient_failures_do_not_count(db, message):
+	save_statuses({message(): ('undelivered', '30008')})
+	assert user(db)['failures'] == 0
+
+def test_delivery_resets_failures(db, message):
+	save_statuses({message(sid='SM1'): ('undelivered', '30003')})
+	save_statuses({message(sid='SM2'): ('delivered', None)})
+	assert user(db)['failures'] == 0
+
+def test_early_callback_is_applied_once_sid_is_saved(db, message):
+	save_statuses({'SM9': ('sent', None)})
+	save_statuses({'SM9': ('delivered', None)})
+	save_statuses({'SM9': ('sent', None)})
+	parked = db.execute('SELECT status FROM status_pending WHERE sid = ?', ('SM9',)).fetchone()
+	assert parked['status'] == 'delivered'
+	message(sid='SM9')
+	save_statuses({})
+	assert delivery(db, 'SM9') == ('delivered', None)
+	assert db.execute('SELECT COUNT(*) FROM status_pending').fetchone()[0] == 0
+
+def test_unmatched_callbacks_expire(db, monkeypatch):
+	save_statuses({'SM9': ('delivered', None)})
+	monkeypatch.setattr(status, 'PENDING_TTL', -1)
+	save_statuses({})
+	assert db.execute('SELECT COUNT(*) FROM status_pending').fetchone()[0] == 0
+
+def test_callback_requires_signature(app):
+	client = app.test_client()
+	response = client.post('/twilio/status', data={'MessageSid': 'SM1', 'MessageStatus': 'sent'})
+	assert response.status_code == 403
+
+def test_callback_is_buffered(app, monkeypatch):
+	monkeypatch.setattr(status, 'valid_signature', lambda: True)
+	buffer = app.extensions['status_buffer']
+	buffer.thread = object()
+	response = app.test_client().post(
+		'/twilio/status',
+		data={'MessageSid': 'SM1', 'MessageStatus': 'undelivered', 'ErrorCode': '30003'},
+	)
+	assert response.status_code == 204
+	assert buffer.pending == {'SM1': ('undelivered', '30003')}
+	buffer.pending.clear()
+
+def test_reinstate_number(app, db, message, monkeypatch):
+	monkeypatch.setattr(status, 'SUSPEND_AFTER', 1)
+	save_statuses({message(): ('failed', '30005')})
+	result = app.test_cli_runner().invoke(args=['reinstate-number', '+15550001'])
+	assert 'Reinstated' in result.output
+	assert tuple(user(db)) == (0, None)
+
+def test_unused_buffer_does_not_touch_database(tmp_path):
+	from menuNotifierApp import create_app
+	database = tmp_path / 'missing.sqlite'
+	app = create_app({'TESTING': True, 'DATABASE': str(database)})
+	assert app.extensions['status_buffer'].flush() == 0
+	assert not database.exists()